@@ -8,6 +8,7 @@ from src.common.session_state import get_session_state
 from src.login.login import Login
 from src.login.username_password_manager import UsernamePasswordManagerArgon2
 from src.submissions.submissions_manager import SubmissionManager
+from src.submissions.results_index import results_index
 from src.config import (SUBMISSIONS_DIR, EVALUATOR_CLASS, EVALUATOR_KWARGS, PASSWORDS_DB_FILE,
                         ARGON2_KWARGS, ALLOWED_SUBMISSION_FILE_EXTENSION, MAX_NUM_USERS, ADMIN_USERNAME)
 from src.submissions.submission_sidebar import SubmissionSidebar
@@ -15,6 +16,10 @@ from src.evaluation.evaluator import Evaluator
 from src.display.leaderboard import Leaderboard
 from src.display.personal_progress import PersonalProgress
 from src.common.css_utils import set_block_container_width
+from src.evaluation.embedding_cache import embedding_cache
+from src.evaluation.verdict_cache import verdict_cache
+from src.evaluation.instrumentation import metrics
+from src.display.evaluation_metrics import EvaluationMetricsPanel
 from dotenv import load_dotenv
 import random
 import os
@@ -34,20 +39,24 @@ st.title('🎖️ AI Challenge Day Leaderboard')
 # Load environment's settings
 load_dotenv()
 
-CONFIGS = [
-    {
-        "endpoint": os.getenv("AZURE_OPENAI_ENDPOINT_1"),
-        "api_key": os.getenv("AZURE_OPENAI_API_KEY_1")
-    },
-    {
-        "endpoint": os.getenv("AZURE_OPENAI_ENDPOINT_2"),
-        "api_key": os.getenv("AZURE_OPENAI_API_KEY_2")
-    },
-    {
-        "endpoint": os.getenv("AZURE_OPENAI_ENDPOINT_3"),
-        "api_key": os.getenv("AZURE_OPENAI_API_KEY_3")
+def getenv_float(name: str):
+    value = os.getenv(name)
+    return float(value) if value else None
+
+
+def get_endpoint_config(n: int) -> dict:
+    return {
+        "endpoint": os.getenv(f"AZURE_OPENAI_ENDPOINT_{n}"),
+        "api_key": os.getenv(f"AZURE_OPENAI_API_KEY_{n}"),
+        # 1分あたりのリクエスト数とトークン数の割り当て（未設定の場合は既定値）
+        "rpm": getenv_float(f"AZURE_OPENAI_RPM_{n}"),
+        "tpm": getenv_float(f"AZURE_OPENAI_TPM_{n}"),
+        "embed_rpm": getenv_float(f"AZURE_OPENAI_EMBED_RPM_{n}"),
+        "embed_tpm": getenv_float(f"AZURE_OPENAI_EMBED_TPM_{n}"),
     }
-]
+
+
+CONFIGS = [get_endpoint_config(n) for n in (1, 2, 3)]
 
 
 def get_login() -> Login:
@@ -55,9 +64,10 @@ def get_login() -> Login:
     return Login(password_manager, MAX_NUM_USERS)
 
 
-#@st.cache_data
+# 提出の状態は全セッションで共有する（スレッドセーフ）。画面の各部品はこれを参照するだけの軽いオブジェクト
+@st.cache_resource
 def get_submission_manager():
-    return SubmissionManager(SUBMISSIONS_DIR)
+    return SubmissionManager(SUBMISSIONS_DIR, results_index)
 
 
 #@st.cache_data
@@ -67,7 +77,7 @@ def get_submission_sidebar(username: str) -> SubmissionSidebar:
                              submission_file_extension=ALLOWED_SUBMISSION_FILE_EXTENSION)
 
 
-#@st.cache_data
+@st.cache_resource
 def get_evaluator() -> Evaluator:
     return EVALUATOR_CLASS(**EVALUATOR_KWARGS)
 
@@ -92,6 +102,18 @@ def admin_display_personal_progress():
     if selected_user is not None:
         get_personal_progress(selected_user).show_progress(progress_placeholder)
 
+
+def admin_display_cache_stats():
+    with st.sidebar.expander('Embedding cache'):
+        st.json(embedding_cache.stats())
+    with st.sidebar.expander('Judge verdict cache'):
+        st.json(verdict_cache.stats())
+
+
+def admin_display_evaluation_metrics():
+    if st.sidebar.checkbox('Show evaluation metrics'):
+        EvaluationMetricsPanel(metrics).show()
+
 #session_state_id = st.session_state.get('_session_state_id')
 login = get_session_state(login=get_login()).login
 login.init()
@@ -113,6 +135,8 @@ if login.run_and_return_if_access_is_allowed() and not login.has_user_signed_out
         get_personal_progress(username).show_progress(progress_placeholder)
     if username == ADMIN_USERNAME:
         admin_display_personal_progress()
+        admin_display_cache_stats()
+        admin_display_evaluation_metrics()
 else:
     get_leaderboard().display_leaderboard('', leaderboard_placeholder)
 
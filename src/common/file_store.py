@@ -0,0 +1,142 @@
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, IO, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: 複数プロセスでの共有はサポートしない
+    fcntl = None
+
+
+@contextmanager
+def atomic_write(path: Path, mode: str = 'wb') -> Iterator[IO]:
+    """Writes to a temporary file next to path and renames it over path once complete, so that other processes
+    never see a partially written file."""
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_name, path)
+    except BaseException:
+        try:
+            os.unlink(temp_name)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class _LockFile:
+    """The lock file at one path, shared by all threads of this process.
+
+    lockf locks belong to the process: they do not exclude the process's other threads, and closing any
+    descriptor of the file releases them. So threads take `thread_lock` before lockf, and the file is opened
+    only once, staying open while any thread holds or waits for the lock.
+    """
+
+    def __init__(self, lock_path: Path):
+        self.lock_path = lock_path
+        self.thread_lock = threading.Lock()
+        self.file = open(lock_path, 'a+b')
+        self.users = 0
+
+
+_lock_files: Dict[Path, _LockFile] = dict()
+_lock_files_lock = threading.Lock()
+
+
+def _open_lock_file(lock_path: Path) -> _LockFile:
+    lock_path = lock_path.resolve()
+    with _lock_files_lock:
+        lock_file = _lock_files.get(lock_path)
+        if lock_file is None:
+            lock_file = _lock_files[lock_path] = _LockFile(lock_path)
+        lock_file.users += 1
+        return lock_file
+
+
+def _close_lock_file(lock_file: _LockFile):
+    with _lock_files_lock:
+        lock_file.users -= 1
+        # 使っているスレッドがなくなってから閉じるので、他のスレッドのロックが外れることはない
+        if lock_file.users == 0:
+            lock_file.file.close()
+            del _lock_files[lock_file.lock_path]
+
+
+@contextmanager
+def file_lock(lock_path: Path, shared: bool = False) -> Iterator[None]:
+    """Advisory lock shared by all threads and processes (and machines, on a network share) that use the same
+    lock file. Threads of one process take it one at a time, even when shared."""
+    lock_file = _open_lock_file(lock_path)
+    try:
+        with lock_file.thread_lock:
+            if fcntl is None:
+                yield
+                return
+            # lockf (POSIX のレコードロック) は flock と違い NFS/SMB 上でも他のマシンとの間で有効
+            fcntl.lockf(lock_file.file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock_file.file, fcntl.LOCK_UN)
+    finally:
+        _close_lock_file(lock_file)
+
+
+class HeldLock:
+    """A lock taken by try_lock, held until it is closed (or the process exits)."""
+
+    def __init__(self, lock_file: _LockFile):
+        self._lock_file = lock_file
+
+    def close(self):
+        if self._lock_file is None:
+            return
+        if fcntl is not None:
+            fcntl.lockf(self._lock_file.file, fcntl.LOCK_UN)
+        self._lock_file.thread_lock.release()
+        _close_lock_file(self._lock_file)
+        self._lock_file = None
+
+
+def try_lock(lock_path: Path) -> Optional[HeldLock]:
+    """Takes an exclusive advisory lock without waiting. Returns None if another thread or process holds it."""
+    lock_file = _open_lock_file(lock_path)
+    if not lock_file.thread_lock.acquire(blocking=False):
+        _close_lock_file(lock_file)
+        return None
+    if fcntl is not None:
+        try:
+            fcntl.lockf(lock_file.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.thread_lock.release()
+            _close_lock_file(lock_file)
+            return None
+    return HeldLock(lock_file)
+
+
+class StoreVersion:
+    """A counter kept in a file, incremented by every process that changes the store it belongs to."""
+
+    def __init__(self, version_file: Path):
+        self.version_file = version_file
+        self._lock_file = version_file.with_name(version_file.name + '.lock')
+
+    def read(self) -> int:
+        try:
+            return int(self.version_file.read_text() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def bump(self) -> int:
+        with file_lock(self._lock_file):
+            version = self.read() + 1
+            with atomic_write(self.version_file, 'w') as f:
+                f.write(str(version))
+        return version
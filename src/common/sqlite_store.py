@@ -0,0 +1,61 @@
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+
+class SqliteBlobStore:
+    """A small persistent key -> bytes store backed by a single SQLite table.
+
+    The connection is opened lazily and shared by all threads of the process. The database uses a rollback
+    journal rather than WAL, whose shared memory is not safe on network file systems such as SMB or NFS, so
+    db_file can be on a share used by several instances.
+    """
+
+    def __init__(self, db_file: Path, table: str):
+        self.db_file = db_file
+        self.table = table
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.db_file), check_same_thread=False, timeout=30)
+            # WAL で作られた既存のデータベースもロールバックジャーナルに戻す
+            connection.execute('PRAGMA journal_mode=DELETE')
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+            self._connection = connection
+        return self._connection
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, bytes]:
+        keys = list(keys)
+        found = dict()
+        with self._lock:
+            connection = self._connect()
+            # SQLite のパラメータ数の上限を超えないように分割して問い合わせる
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = connection.execute(f'SELECT key, value FROM {self.table} WHERE key IN ({placeholders})', chunk)
+                found.update(rows.fetchall())
+        return found
+
+    def put_many(self, items: Dict[str, bytes]):
+        if not items:
+            return
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(f'INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)',
+                                       list(items.items()))
+
+    def count(self) -> int:
+        with self._lock:
+            return self._connect().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
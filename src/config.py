@@ -1,3 +1,4 @@
+import tempfile
 from pathlib import Path
 
 from src.examples.f1_precision_recall_example import ExampleEvaluator
@@ -22,3 +23,89 @@ ALLOWED_SUBMISSION_FILE_EXTENSION = 'csv'
 SHOW_TOP_K_ONLY = 5
 
 ADMIN_USERNAME = 'admin'
+
+# Number of CSV rows evaluated concurrently against Azure OpenAI. 1 evaluates the rows one by one.
+EVAL_CONCURRENCY = 8
+
+# Connection pooling for the Azure OpenAI clients. One client per endpoint is shared by all evaluations.
+AZURE_OPENAI_MAX_CONNECTIONS = 100
+AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS = 20
+AZURE_OPENAI_KEEPALIVE_EXPIRY = 30.0
+# Timeouts (seconds) for a single request to Azure OpenAI
+AZURE_OPENAI_TIMEOUT = 60.0
+AZURE_OPENAI_CONNECT_TIMEOUT = 10.0
+
+# Embedding requests of many rows are sent together. A batch is sent when it reaches one of the
+# limits below, or after EMBEDDING_BATCH_MAX_DELAY seconds.
+EMBEDDING_BATCH_MAX_ITEMS = 256
+EMBEDDING_BATCH_MAX_TOKENS = 64000
+EMBEDDING_BATCH_MAX_DELAY = 0.05
+
+# Persistent caches are kept on the /home share, so they survive restarts and deploys and are shared by all
+# instances. They are SQLite databases in rollback-journal mode, which (unlike WAL) is safe on a network share.
+CACHE_DIR = Path('/home/site/wwwroot/cache')
+
+# Persistent cache of embedding vectors, keyed by (embedding deployment, text)
+EMBEDDING_CACHE_FILE = CACHE_DIR.joinpath('embeddings.db')
+# Upper bound of the in-memory tier of the embedding cache, in bytes
+EMBEDDING_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+
+# Persistent cache of LLM judge verdicts, keyed by (chat deployment, rendered prompt)
+VERDICT_CACHE_FILE = CACHE_DIR.joinpath('verdicts.db')
+# Number of verdicts kept in memory in front of the persistent cache
+VERDICT_CACHE_MEMORY_ITEMS = 100000
+
+# Default per-endpoint quota, used when AZURE_OPENAI_RPM_n / AZURE_OPENAI_TPM_n (or the EMBED_ variants)
+# are not set. Requests are routed to the endpoint with the most remaining quota.
+AZURE_OPENAI_DEFAULT_RPM = 300
+AZURE_OPENAI_DEFAULT_TPM = 50000
+
+# Number of evaluation jobs run at the same time by the background worker. Queued jobs wait for a free slot.
+EVAL_MAX_CONCURRENT_JOBS = 4
+# Finished evaluation jobs are forgotten after this many seconds
+EVAL_JOB_RETENTION_SECONDS = 60 * 60
+
+# How the LLM judge is asked for the gpt_* metrics:
+#   'per_metric' - one request per metric with its own few-shot prompt
+#   'combined'   - one request per row that returns all ratings as JSON, falling back to the per-metric
+#                  prompts for any rating that cannot be parsed
+JUDGE_MODE = 'per_metric'
+
+# Submissions are parsed and fed to the evaluation in chunks of this many rows
+CSV_CHUNK_ROWS = 500
+# Number of rows of an uploaded submission shown as a preview
+CSV_PREVIEW_ROWS = 20
+
+# While an evaluation runs, only its progress area is redrawn, once per PROGRESS_UPDATE_INTERVAL seconds,
+# and the status log shows only the last PROGRESS_LOG_ROWS rows.
+PROGRESS_UPDATE_INTERVAL = 1.0
+PROGRESS_LOG_ROWS = 20
+
+# Retries of Azure OpenAI calls. A Retry-After sent by the service is honoured by the endpoint scheduler,
+# otherwise retries back off exponentially between RETRY_MIN_WAIT and RETRY_MAX_WAIT seconds.
+RETRY_MAX_ATTEMPTS = 6
+RETRY_MIN_WAIT = 1.0
+RETRY_MAX_WAIT = 30.0
+# An endpoint is taken out of rotation for CIRCUIT_OPEN_SECONDS after this many consecutive failures
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_OPEN_SECONDS = 30.0
+# Overall time limit for evaluating one submission, in seconds
+EVAL_SUBMISSION_DEADLINE_SECONDS = 30 * 60
+
+# Index of all submissions' scores, so the leaderboard does not have to scan SUBMISSIONS_DIR.
+# Each process rebuilds it from the files when it starts, so it belongs on local disk rather than on the
+# (network) volume shared by several instances. Processes on the same machine share it; a rebuild replaces its
+# contents in a single transaction, so they never read a half-built index.
+# Rebuild it by hand with: python -m src.submissions.results_index rebuild
+RESULTS_INDEX_FILE = Path(tempfile.gettempdir()).joinpath('leaderboard', 'results.db')
+
+# How changes to SUBMISSIONS_DIR made outside this process are detected:
+# 'auto' (inotify via watchdog if installed, otherwise polling), 'inotify' or 'poll'.
+# inotify does not see changes made by other machines on a network share; use 'poll' when scaled out.
+SUBMISSIONS_WATCH_MODE = 'auto'
+# Seconds between two checks of the directories' modification times in 'poll' mode
+SUBMISSIONS_POLL_INTERVAL = 5.0
+
+# An upload identical to one already evaluated (same file content) reuses the stored result instead of being
+# evaluated again. If True, results evaluated for other participants are reused too.
+DEDUPLICATE_ACROSS_PARTICIPANTS = False
@@ -0,0 +1,23 @@
+import pandas as pd
+import streamlit as st
+
+from src.evaluation.endpoint_scheduler import get_all_scheduler_stats
+from src.evaluation.instrumentation import MetricsRegistry
+
+
+class EvaluationMetricsPanel:
+    """Admin-only view of the evaluation pipeline instrumentation."""
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+
+    def show(self):
+        st.subheader('Evaluation pipeline metrics')
+        st.markdown('#### Endpoints')
+        st.dataframe(pd.DataFrame(get_all_scheduler_stats()), use_container_width=True)
+        st.markdown('#### Latency (seconds)')
+        st.dataframe(pd.DataFrame(self.registry.latency_table()), use_container_width=True)
+        st.markdown('#### Counters and in-flight requests')
+        st.dataframe(pd.DataFrame(self.registry.counter_table()), use_container_width=True)
+        st.download_button('Download metrics (Prometheus text format)', self.registry.to_prometheus_text(),
+                           file_name='metrics.prom', mime='text/plain')
@@ -1,11 +1,31 @@
-from typing import Dict
+import threading
+from typing import Callable, Optional
 
 import streamlit as st
 import pandas as pd
 
 from src.config import SHOW_TOP_K_ONLY, ADMIN_USERNAME
 from src.evaluation.evaluator import Evaluator
-from src.submissions.submissions_manager import SubmissionManager, SingleParticipantSubmissions
+from src.submissions.submissions_manager import SubmissionManager
+
+
+class MaterializedLeaderboard:
+    """The sorted leaderboard, shared by all sessions and rebuilt only when the submissions' version changes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version: Optional[int] = None
+        self._leaderboard: Optional[pd.DataFrame] = None
+
+    def get(self, version: Optional[int], build: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        with self._lock:
+            if version is None or version != self._version or self._leaderboard is None:
+                self._leaderboard = build()
+                self._version = version
+            return self._leaderboard
+
+
+materialized_leaderboard = MaterializedLeaderboard()
 
 
 class Leaderboard:
@@ -14,59 +34,34 @@ class Leaderboard:
         self.submissions_manager = submissions_manager
         self.evaluator = evaluator
         
-    # このキャッシュを効かせると、ファイルを変更した際にdataframe の内容が更新されない
-    #@st.cache(hash_funcs={SingleParticipantSubmissions: lambda x: x.submissions_hash()}, show_spinner=False, suppress_st_warning=True)
-    #@st.cache_data(hash_funcs={SingleParticipantSubmissions: lambda x: x.submissions_hash()}, show_spinner=False)
-    def _get_sorted_leaderboard(_self, participants_dict: Dict[str, SingleParticipantSubmissions],
-                                username: str) -> pd.DataFrame:
-        for participant in participants_dict.values():
-            participant.update_results(_self.evaluator)
-        #metric_names = [metric.name() for metric in self.evaluator.metrics()]
-        #print("self.evaluator.metrics()", metric_names)
-        metric_names = ['score']
-        # leaderboard = pd.DataFrame([[pname, SingleParticipantSubmissions.get_datetime_from_path(best_result[0]),
-        #                              *best_result[1]] for pname, 
-        #                              best_result in [(pname, p.get_best_result()) for pname, p in participants_dict.items()]
-        #                             if best_result is not None],
-        #                            columns=['Competitor', 'Submission Time', *metric_names])
+    # st.cache_data ではファイルを変更した際に dataframe の内容が更新されないため、
+    # 提出のバージョン番号が変わったときだけ作り直す materialized_leaderboard を使う
+    def _get_sorted_leaderboard(_self, username: str) -> pd.DataFrame:
+        leaderboard = materialized_leaderboard.get(
+            _self.submissions_manager.get_version(),
+            _self._build_leaderboard)
+        if username != ADMIN_USERNAME:
+            leaderboard = leaderboard.iloc[:SHOW_TOP_K_ONLY]
+        return leaderboard
 
-        # ステップ 1: 各参加者の最良結果を取得する
-        best_results = [
-            (pname, p.get_best_result()) 
-            for pname, p in participants_dict.items()
-        ]
-        # ステップ 2: 最良結果が None でないエントリをフィルタリングする
-        filtered_best_results = [
-            (pname, best_result) 
-            for pname, best_result in best_results 
-            if best_result is not None
-        ]
-        # ステップ 3: 必要な情報を抽出してリストを生成する
-        data = [
-            [
-                pname,
-                SingleParticipantSubmissions.get_datetime_from_path(best_result[0]),
-                best_result[1]
-            ] 
-            for pname, best_result in filtered_best_results
-        ]
-        # ステップ 4: データフレームを作成する
+    def _build_leaderboard(_self) -> pd.DataFrame:
+        _self.submissions_manager.update_results(_self.evaluator)
+        # ランキングは提出が追加されるたびに並び順を保っているので、ここでは並べ替えない
+        data = [[record.participant_name, record.submitted_at, record.result.value]
+                for record in _self.submissions_manager.ranking.top()]
         leaderboard = pd.DataFrame(data, columns=['Competitor', 'Submission Time', 'score'])
-        
-        # カスタムオブジェクトを適切な型に変換
-        leaderboard['score'] = leaderboard['score'].apply(lambda x: x.value)
-
-        leaderboard = leaderboard.sort_values(by=metric_names + ['Submission Time'],
-                                              ascending=[False] * len(metric_names) + [True], ignore_index=True)
-        
         leaderboard.index += 1
-        if username != ADMIN_USERNAME:
-            leaderboard = leaderboard.iloc[:SHOW_TOP_K_ONLY]
         return leaderboard
 
+    def get_rank(self, username: str) -> Optional[int]:
+        self.submissions_manager.update_results(self.evaluator)
+        return self.submissions_manager.get_rank(username)
+
     def display_leaderboard(self, username: str, leaderboard_placeholder = None):
-        leaderboard = self._get_sorted_leaderboard(self.submissions_manager.participants, username)
-        if leaderboard_placeholder is not None:
-            leaderboard_placeholder.table(leaderboard)
-        else:
-            st.table(leaderboard)
+        leaderboard = self._get_sorted_leaderboard(username)
+        container = leaderboard_placeholder.container() if leaderboard_placeholder is not None else st.container()
+        container.table(leaderboard)
+        if username and username != ADMIN_USERNAME:
+            rank = self.get_rank(username)
+            if rank is not None:
+                container.caption(f'Your rank: {rank} / {len(self.submissions_manager.ranking)}')
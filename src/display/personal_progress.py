@@ -36,17 +36,17 @@ class PersonalProgress:
         #                            columns=[self.submission_name_column, self.submission_time_column,
         #                                     *self.metric_names])
 
-        # ステップ 1: 各提出ファイルパスと提出結果を取得する
-        submissions = list(_self.participant_submissions.results.items())
+        # ステップ 1: 各提出のレコード（名前・日時・結果は解析済み）を取得する
+        records = _self.participant_submissions.get_records()
 
-        # ステップ 2: 各提出ファイルパスと提出結果から必要な情報を抽出する
+        # ステップ 2: 各レコードから必要な情報を抽出する
         submission_data = [
             [
-                _self.participant_submissions.get_submission_name_from_path(submission_filepath),
-                _self.participant_submissions.get_datetime_from_path(submission_filepath),
-                submission_results.value  # ここでF1の値を取得
+                record.submission_name,
+                record.submitted_at,
+                record.result.value  # ここでF1の値を取得
             ]
-            for submission_filepath, submission_results in submissions
+            for record in records if record.result is not None
         ]
 
         # ステップ 3: データフレームを作成する
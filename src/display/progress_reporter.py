@@ -0,0 +1,42 @@
+from typing import Iterable, Tuple
+
+import pandas as pd
+import streamlit as st
+
+from src.config import PROGRESS_LOG_ROWS
+
+
+class ProgressReporter:
+    """Shows the progress of an evaluation: a progress bar, a status line and a rolling table of the most recent
+    rows, which is replaced in place instead of appended to.
+
+    It draws a snapshot of the job. While the job runs it is drawn inside a fragment that reruns every
+    PROGRESS_UPDATE_INTERVAL seconds, so only the progress area is sent to the browser.
+    """
+
+    def __init__(self, log_rows: int = PROGRESS_LOG_ROWS):
+        self.log_rows = log_rows
+        # 進捗バーの初期化
+        self.progress_bar = st.progress(0)
+        self.status_text = st.empty()
+        self.status = st.status("Evaluating...", expanded=True)
+        self.log_placeholder = self.status.empty()
+
+    def update(self, completed: int, total: int, recent_rows: Iterable[Tuple[int, dict]] = ()):
+        if total > 0:
+            # ステータスの更新
+            self.status_text.text(f'Evaluating: {completed}/{total} rows')
+            self.progress_bar.progress(min(completed / total, 1.0))
+        recent_rows = list(recent_rows)[-self.log_rows:]
+        if recent_rows:
+            log = pd.DataFrame([{'row': position, **processed_row} for position, processed_row in recent_rows])
+            self.log_placeholder.dataframe(log.set_index('row'), use_container_width=True)
+
+    def complete(self):
+        # ステータスのクリア
+        self.status_text.text('Evaluation complete')
+        self.status.update(label="Evaluation complete!", state="complete", expanded=False)
+
+    def fail(self):
+        self.status_text.text('Evaluation failed')
+        self.status.update(label="Evaluation failed", state="error", expanded=False)
@@ -0,0 +1,99 @@
+import json
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from src.common.file_store import atomic_write, try_lock
+
+
+class EvaluationCheckpoint:
+    """Persists an evaluation while it runs, so it can resume after a restart.
+
+    The uploaded file and its metadata are stored when the job starts and every finished row is appended to
+    an append-only JSONL file. Lives in `<participant dir>/.checkpoints/<job id>/` and is removed when the job
+    finishes, whether it succeeded or failed, so only evaluations interrupted by a stopped process are resumed. The process running the evaluation holds a lock on the checkpoint, so that other
+    processes sharing the directory do not resume it as well.
+    """
+    checkpoints_dirname = '.checkpoints'
+    _meta_filename = 'meta.json'
+    _rows_filename = 'rows.jsonl'
+    _submission_filename = 'submission'
+    _owner_lock_filename = '.owner.lock'
+
+    def __init__(self, checkpoint_dir: Path):
+        self.checkpoint_dir = checkpoint_dir
+        self.job_id = checkpoint_dir.parts[-1]
+        self._rows_file = None
+        self._owner_lock = None
+
+    def claim(self) -> bool:
+        """Locks the checkpoint for this process. Returns False if another process is running it."""
+        if self._owner_lock is None:
+            self._owner_lock = try_lock(self.checkpoint_dir.joinpath(self._owner_lock_filename))
+        return self._owner_lock is not None
+
+    @classmethod
+    def create(cls, participant_dir: Path, job_id: str, submission_bytes: bytes, submission_name: Optional[str],
+               file_extension: Optional[str], content_hash: str) -> 'EvaluationCheckpoint':
+        checkpoint = cls(participant_dir.joinpath(cls.checkpoints_dirname, job_id))
+        checkpoint.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        if not checkpoint.claim():
+            raise RuntimeError(f'The checkpoint {checkpoint.checkpoint_dir} is already in use.')
+        with atomic_write(checkpoint.checkpoint_dir.joinpath(cls._submission_filename)) as f:
+            f.write(submission_bytes)
+        meta = {'submission_name': submission_name, 'file_extension': file_extension, 'content_hash': content_hash}
+        # meta.json があるチェックポイントだけが再開の対象になるため、最後に書く
+        with atomic_write(checkpoint.checkpoint_dir.joinpath(cls._meta_filename), 'w') as f:
+            f.write(json.dumps(meta))
+        return checkpoint
+
+    @classmethod
+    def find_pending(cls, participant_dir: Path) -> List['EvaluationCheckpoint']:
+        checkpoints_dir = participant_dir.joinpath(cls.checkpoints_dirname)
+        if not checkpoints_dir.is_dir():
+            return []
+        return [cls(x) for x in sorted(checkpoints_dir.iterdir())
+                if x.is_dir() and x.joinpath(cls._meta_filename).is_file()]
+
+    def load_meta(self) -> dict:
+        return json.loads(self.checkpoint_dir.joinpath(self._meta_filename).read_text())
+
+    def load_submission_bytes(self) -> bytes:
+        return self.checkpoint_dir.joinpath(self._submission_filename).read_bytes()
+
+    def load_rows(self) -> Dict[int, dict]:
+        rows_path = self.checkpoint_dir.joinpath(self._rows_filename)
+        rows = dict()
+        if not rows_path.is_file():
+            return rows
+        with rows_path.open('r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で停止した最後の行は読み飛ばす
+                    continue
+                rows[entry['position']] = entry['scores']
+        return rows
+
+    def append_row(self, position: int, processed_row: dict):
+        if self._rows_file is None:
+            self._rows_file = self.checkpoint_dir.joinpath(self._rows_filename).open('a')
+        self._rows_file.write(json.dumps({'position': position, 'scores': processed_row}) + '\n')
+        self._rows_file.flush()
+
+    def _close_rows_file(self):
+        if self._rows_file is not None:
+            self._rows_file.close()
+            self._rows_file = None
+
+    def _release(self):
+        if self._owner_lock is not None:
+            self._owner_lock.close()
+            self._owner_lock = None
+
+    def remove(self):
+        self._close_rows_file()
+        # 削除し終えるまではロックを保持し、他のプロセスが再開しないようにする
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+        self._release()
@@ -0,0 +1,84 @@
+import asyncio
+import atexit
+import threading
+from typing import Dict, Tuple
+
+import httpx
+from openai import AsyncAzureOpenAI
+
+from src.config import (AZURE_OPENAI_MAX_CONNECTIONS, AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                        AZURE_OPENAI_KEEPALIVE_EXPIRY, AZURE_OPENAI_TIMEOUT, AZURE_OPENAI_CONNECT_TIMEOUT)
+
+
+class AzureOpenAIClientPool:
+    """Process-wide pool of AsyncAzureOpenAI clients, one per endpoint in CONFIGS.
+
+    httpx connections belong to the event loop that opened them, so clients are kept per event loop
+    and every evaluation running on the same loop shares the same keep-alive connections.
+    """
+
+    def __init__(self, max_connections: int = AZURE_OPENAI_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry: float = AZURE_OPENAI_KEEPALIVE_EXPIRY,
+                 timeout: float = AZURE_OPENAI_TIMEOUT,
+                 connect_timeout: float = AZURE_OPENAI_CONNECT_TIMEOUT):
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections,
+                                   keepalive_expiry=keepalive_expiry)
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple[int, str, str, str], Tuple[asyncio.AbstractEventLoop, AsyncAzureOpenAI]] = dict()
+
+    def get_client(self, config: dict, api_version: str) -> AsyncAzureOpenAI:
+        loop = asyncio.get_running_loop()
+        key = (id(loop), config["endpoint"], config["api_key"], api_version)
+        with self._lock:
+            self._drop_closed_loops()
+            entry = self._clients.get(key)
+            if entry is None or entry[0] is not loop:
+                client = AsyncAzureOpenAI(
+                    api_key=config["api_key"],
+                    api_version=api_version,
+                    azure_endpoint=config["endpoint"],
+                    timeout=self.timeout,
+                    # 再試行は呼び出し側で行い、429 や失敗をスケジューラーと計測に見えるようにする
+                    max_retries=0,
+                    http_client=httpx.AsyncClient(limits=self.limits, timeout=self.timeout),
+                )
+                entry = (loop, client)
+                self._clients[key] = entry
+            return entry[1]
+
+    def _drop_closed_loops(self):
+        # ループが閉じられると接続も使えなくなるため、そのクライアントは破棄する
+        for key in [key for key, (loop, _) in self._clients.items() if loop.is_closed()]:
+            del self._clients[key]
+
+    async def aclose_loop_clients(self):
+        """Closes the clients that belong to the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            keys = [key for key, (client_loop, _) in self._clients.items() if client_loop is loop]
+            clients = [self._clients.pop(key)[1] for key in keys]
+        for client in clients:
+            await client.close()
+
+    def close(self, timeout: float = 5.0):
+        """Closes every client in the pool. Registered to run at interpreter shutdown."""
+        with self._lock:
+            entries = list(self._clients.values())
+            self._clients.clear()
+        for loop, client in entries:
+            if loop.is_closed():
+                continue
+            try:
+                if loop.is_running():
+                    asyncio.run_coroutine_threadsafe(client.close(), loop).result(timeout)
+                else:
+                    loop.run_until_complete(client.close())
+            except Exception as e:
+                print("Failed to close Azure OpenAI client:", e)
+
+
+client_pool = AzureOpenAIClientPool()
+atexit.register(client_pool.close)
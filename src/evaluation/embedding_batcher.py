@@ -0,0 +1,94 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from src.config import EMBEDDING_BATCH_MAX_ITEMS, EMBEDDING_BATCH_MAX_TOKENS, EMBEDDING_BATCH_MAX_DELAY
+
+
+def estimate_tokens(text: str) -> int:
+    # 英語はおよそ4文字で1トークン、日本語などの非ASCII文字は1文字1トークンとして多めに見積もる
+    non_ascii = sum(1 for c in text if ord(c) > 127)
+    return non_ascii + (len(text) - non_ascii) // 4 + 1
+
+
+class EmbeddingBatcher:
+    """Collects texts from many rows and sends them in multi-input embeddings requests.
+
+    `submit` queues a text and returns a future that resolves to its embedding vector. A batch is sent as
+    soon as it reaches `max_items` texts or `max_tokens` estimated tokens, or after `max_delay` seconds.
+    """
+
+    def __init__(self, embed_texts: Callable[[List[str]], Awaitable[List[List[float]]]],
+                 max_items: int = EMBEDDING_BATCH_MAX_ITEMS,
+                 max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+                 max_delay: float = EMBEDDING_BATCH_MAX_DELAY):
+        self.embed_texts = embed_texts
+        self.max_items = max_items
+        self.max_tokens = max_tokens
+        self.max_delay = max_delay
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._pending_tokens = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._inflight = set()
+
+    def submit(self, text: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        tokens = estimate_tokens(text)
+        if self._pending and self._pending_tokens + tokens > self.max_tokens:
+            self.flush()
+        self._pending.append((text, future))
+        self._pending_tokens += tokens
+        if len(self._pending) >= self.max_items:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_delay, self.flush)
+        return future
+
+    async def embed(self, text: str) -> List[float]:
+        return await self.submit(text)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        batch = self._pending
+        self._pending = []
+        self._pending_tokens = 0
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]]):
+        # 同じテキストは一度だけ送る
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = await self.embed_texts(texts)
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        vector_by_text = dict(zip(texts, vectors))
+        for text, future in batch:
+            if not future.done():
+                future.set_result(vector_by_text[text])
+
+    async def aclose(self):
+        """Cancels the texts that were not sent and the requests in flight, and waits for them to finish."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        for _, future in self._pending:
+            future.cancel()
+        self._pending = []
+        self._pending_tokens = 0
+        inflight = list(self._inflight)
+        for task in inflight:
+            task.cancel()
+        await asyncio.gather(*inflight, return_exceptions=True)
@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from src.common.sqlite_store import SqliteBlobStore
+from src.config import EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MEMORY_BYTES
+
+
+class EmbeddingCache:
+    """Content-addressed embedding cache with an in-memory LRU tier over a persistent SQLite tier.
+
+    Vectors are keyed by a hash of (deployment name, text) and stored as float32.
+    """
+
+    def __init__(self, db_file: Path, max_memory_bytes: int = EMBEDDING_CACHE_MEMORY_BYTES):
+        self.store = SqliteBlobStore(db_file, 'embeddings')
+        self.max_memory_bytes = max_memory_bytes
+        self._lock = threading.Lock()
+        self._memory: 'OrderedDict[str, np.ndarray]' = OrderedDict()
+        self._memory_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(deployment: str, text: str) -> str:
+        return hashlib.sha256(f'{deployment}\0{text}'.encode()).hexdigest()
+
+    def get_many(self, deployment: str, texts: List[str]) -> Dict[str, List[float]]:
+        found, missing = self._get_from_memory(deployment, texts)
+        if missing:
+            self._load(found, missing, self.store.get_many(missing.keys()))
+        return found
+
+    async def aget_many(self, deployment: str, texts: List[str]) -> Dict[str, List[float]]:
+        """Like get_many, but reads SQLite in a worker thread so the event loop is not blocked."""
+        found, missing = self._get_from_memory(deployment, texts)
+        if missing:
+            self._load(found, missing, await asyncio.to_thread(self.store.get_many, list(missing.keys())))
+        return found
+
+    def _get_from_memory(self, deployment: str, texts: List[str]) -> Tuple[Dict[str, List[float]], Dict[str, str]]:
+        keys = {text: self.make_key(deployment, text) for text in texts}
+        found = dict()
+        missing = dict()
+        with self._lock:
+            for text, key in keys.items():
+                vector = self._memory.get(key)
+                if vector is None:
+                    missing[key] = text
+                else:
+                    self._memory.move_to_end(key)
+                    found[text] = vector.tolist()
+            self.memory_hits += len(found)
+        return found, missing
+
+    def _load(self, found: Dict[str, List[float]], missing: Dict[str, str], stored: Dict[str, bytes]):
+        with self._lock:
+            for key, blob in stored.items():
+                vector = np.frombuffer(blob, dtype=np.float32)
+                self._remember(key, vector)
+                found[missing[key]] = vector.tolist()
+            self.disk_hits += len(stored)
+            self.misses += len(missing) - len(stored)
+
+    def put_many(self, deployment: str, vectors: Dict[str, List[float]]):
+        self.store.put_many(self._remember_many(deployment, vectors))
+
+    async def aput_many(self, deployment: str, vectors: Dict[str, List[float]]):
+        """Like put_many, but commits to SQLite in a worker thread so the event loop is not blocked."""
+        await asyncio.to_thread(self.store.put_many, self._remember_many(deployment, vectors))
+
+    def _remember_many(self, deployment: str, vectors: Dict[str, List[float]]) -> Dict[str, bytes]:
+        items = dict()
+        with self._lock:
+            for text, vector in vectors.items():
+                key = self.make_key(deployment, text)
+                vector = np.asarray(vector, dtype=np.float32)
+                self._remember(key, vector)
+                items[key] = vector.tobytes()
+        return items
+
+    def _remember(self, key: str, vector: np.ndarray):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = vector
+        self._memory_bytes += vector.nbytes
+        # 上限を超えたら最も古く使われたものから削除する
+        while self._memory_bytes > self.max_memory_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+
+    def clear_memory(self):
+        """Empties the in-memory tier; the SQLite tier is kept."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else None,
+                'memory_items': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+            }
+
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_FILE)
@@ -0,0 +1,191 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple, Union
+
+from src.config import AZURE_OPENAI_DEFAULT_RPM, AZURE_OPENAI_DEFAULT_TPM
+from src.evaluation.instrumentation import metrics
+from src.evaluation.resilience import (CircuitBreaker, get_retry_after, is_endpoint_failure, check_deadline,
+                                       remaining_time, DeadlineExceededError)
+
+
+class TokenBucket:
+    """Refills `capacity` units per minute, continuously."""
+
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = float(capacity_per_minute)
+        self.available = self.capacity
+        self._updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self._updated_at) * self.capacity / 60)
+        self._updated_at = now
+
+    def can_consume(self, amount: float) -> bool:
+        # 容量より大きい要求はバケツが満杯のときだけ通す
+        return self.available >= min(amount, self.capacity)
+
+    def consume(self, amount: float):
+        self.available -= amount
+
+    def seconds_until(self, amount: float) -> float:
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing * 60 / self.capacity)
+
+    def drain(self):
+        self.available = min(self.available, 0.0)
+
+
+class Endpoint:
+    _ewma_alpha = 0.2
+
+    def __init__(self, config: dict, rpm: float, tpm: float):
+        self.config = config
+        self.name = config["endpoint"]
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.breaker = CircuitBreaker()
+
+    def headroom(self) -> float:
+        return min(self.requests.available / self.requests.capacity, self.tokens.available / self.tokens.capacity)
+
+    def score(self) -> float:
+        # 空き容量が大きく、速く、失敗の少ないエンドポイントほど高い
+        return self.headroom() * (1 - self.error_rate) / ((1 + self.latency) * (1 + self.in_flight))
+
+    def record(self, latency: Optional[float], failed: bool):
+        if latency is not None:
+            self.latency += self._ewma_alpha * (latency - self.latency)
+        self.error_rate += self._ewma_alpha * (float(failed) - self.error_rate)
+
+
+class EndpointScheduler:
+    """Routes each request to the configured endpoint with the most quota headroom.
+
+    Every endpoint has token buckets for requests and tokens per minute. Observed latency and error rates
+    lower an endpoint's priority, a 429 puts it in cooldown for the time the service asked for, and repeated
+    failures open its circuit breaker. Endpoints without an endpoint URL or API key are skipped.
+    """
+
+    def __init__(self, configs: List[dict], rpm_key: str = 'rpm', tpm_key: str = 'tpm', kind: str = 'chat'):
+        self.kind = kind
+        self.endpoints = [Endpoint(config,
+                                   rpm=config.get(rpm_key) or AZURE_OPENAI_DEFAULT_RPM,
+                                   tpm=config.get(tpm_key) or AZURE_OPENAI_DEFAULT_TPM)
+                          for config in configs if config.get("endpoint") and config.get("api_key")]
+        if not self.endpoints:
+            raise RuntimeError("No Azure OpenAI endpoint is configured. Set AZURE_OPENAI_ENDPOINT_n and "
+                               "AZURE_OPENAI_API_KEY_n.")
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, tokens: int) -> Union[Endpoint, float]:
+        now = time.monotonic()
+        with self._lock:
+            candidates = []
+            wait = 1.0
+            for endpoint in self.endpoints:
+                endpoint.requests.refill(now)
+                endpoint.tokens.refill(now)
+                blocked_for = max(endpoint.cooldown_until - now, endpoint.breaker.seconds_until_allowed(now))
+                if blocked_for > 0:
+                    wait = min(wait, blocked_for)
+                elif endpoint.requests.can_consume(1) and endpoint.tokens.can_consume(tokens):
+                    candidates.append(endpoint)
+                else:
+                    wait = min(wait, max(endpoint.requests.seconds_until(1), endpoint.tokens.seconds_until(tokens)))
+            if not candidates:
+                return max(wait, 0.01)
+            endpoint = max(candidates, key=Endpoint.score)
+            endpoint.breaker.on_acquire(now)
+            endpoint.requests.consume(1)
+            endpoint.tokens.consume(tokens)
+            endpoint.in_flight += 1
+            return endpoint
+
+    async def acquire(self, tokens: int) -> Endpoint:
+        while True:
+            check_deadline()
+            endpoint = self._try_acquire(tokens)
+            if isinstance(endpoint, Endpoint):
+                return endpoint
+            remaining = remaining_time()
+            if remaining is not None and endpoint >= remaining:
+                raise DeadlineExceededError("The evaluation deadline was exceeded while waiting for an endpoint.")
+            await asyncio.sleep(endpoint)
+
+    def release(self, endpoint: Endpoint, latency: Optional[float], failed: bool = False,
+                retry_after: Optional[float] = None, endpoint_failure: bool = False):
+        with self._lock:
+            endpoint.in_flight -= 1
+            endpoint.record(latency, failed)
+            if endpoint_failure:
+                endpoint.breaker.record_failure(time.monotonic())
+            else:
+                # 429 などでも応答が返っていれば、エンドポイント自体は動いている
+                endpoint.breaker.record_success()
+            if retry_after is not None:
+                endpoint.cooldown_until = max(endpoint.cooldown_until, time.monotonic() + retry_after)
+                endpoint.requests.drain()
+
+    @asynccontextmanager
+    async def request(self, tokens: int):
+        queued_at = time.monotonic()
+        endpoint = await self.acquire(tokens)
+        started_at = time.monotonic()
+        # 割り当ての空きを待った時間
+        metrics.observe('quota_wait_seconds', started_at - queued_at, operation=self.kind)
+        try:
+            with metrics.track('request', operation=self.kind, endpoint=endpoint.name):
+                yield endpoint
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                metrics.inc('throttled_total', operation=self.kind, endpoint=endpoint.name)
+            self.release(endpoint, None, failed=True, retry_after=retry_after,
+                         endpoint_failure=is_endpoint_failure(e))
+            raise
+        except BaseException:
+            # キャンセルされた場合は結果を記録せずに解放する
+            with self._lock:
+                endpoint.in_flight -= 1
+                endpoint.breaker.release_probe()
+            raise
+        self.release(endpoint, time.monotonic() - started_at)
+
+    def stats(self) -> List[Dict[str, float]]:
+        with self._lock:
+            return [{'endpoint': endpoint.name,
+                     'requests_available': round(endpoint.requests.available, 1),
+                     'tokens_available': round(endpoint.tokens.available),
+                     'latency_ewma': round(endpoint.latency, 3),
+                     'error_rate_ewma': round(endpoint.error_rate, 3),
+                     'in_flight': endpoint.in_flight,
+                     'circuit': endpoint.breaker.state}
+                    for endpoint in self.endpoints]
+
+
+_schedulers: Dict[Tuple[str, Tuple[str, ...]], EndpointScheduler] = dict()
+_schedulers_lock = threading.Lock()
+
+
+def get_endpoint_scheduler(configs: List[dict], kind: str = 'chat') -> EndpointScheduler:
+    """Returns the process-wide scheduler for `kind` ('chat' or 'embeddings') over `configs`."""
+    key = (kind, tuple(config.get("endpoint") or '' for config in configs))
+    with _schedulers_lock:
+        if key not in _schedulers:
+            if kind == 'embeddings':
+                _schedulers[key] = EndpointScheduler(configs, rpm_key='embed_rpm', tpm_key='embed_tpm', kind=kind)
+            else:
+                _schedulers[key] = EndpointScheduler(configs, kind=kind)
+        return _schedulers[key]
+
+
+def get_all_scheduler_stats() -> List[Dict[str, float]]:
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return [{'operation': scheduler.kind, **stats} for scheduler in schedulers for stats in scheduler.stats()]
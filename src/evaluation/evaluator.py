@@ -2,7 +2,7 @@ from io import BytesIO, StringIO
 
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import Tuple, Type, Union
+from typing import Optional, Tuple, Type, Union
 
 from src.evaluation.metric import Metric
 
@@ -17,6 +17,11 @@ class Evaluator(ABC):
     def evaluate(self, filepath: Path) -> Tuple[Metric, ...]:
         pass
 
+    def evaluate_summary(self, summary: dict) -> Optional[Tuple[Metric, ...]]:
+        """Evaluates an indexed submission from its summary (total_score, average_score, ...)
+        instead of reading its file. Returns None if the file is needed, in which case evaluate is used."""
+        return None
+
     @abstractmethod
     def validate_submission(self, io_stream: Union[StringIO, BytesIO]) -> bool:
         pass
@@ -10,6 +10,19 @@ import asyncio
 import random
 import os
 
+from src.evaluation.client_pool import client_pool
+from src.evaluation.settings import get_eval_setting
+from src.config import JUDGE_MODE
+import json
+import re
+from src.evaluation.embedding_cache import embedding_cache
+from src.evaluation.verdict_cache import verdict_cache
+from src.evaluation.endpoint_scheduler import get_endpoint_scheduler
+from src.evaluation.embedding_batcher import estimate_tokens
+from src.evaluation.instrumentation import metrics
+from src.evaluation.resilience import retry_call, remaining_time, is_api_error
+from src.config import AZURE_OPENAI_TIMEOUT
+
 gpt_relevance_prompt_sys = """You are an AI assistant. You will be given the definition of an evaluation metric for assessing the quality of an answer in a question-answering task. Your job is to compute an accurate evaluation score using the provided evaluation metric. You should return a single integer value between 1 to 5 representing the evaluation metric. You will include no other text or information."""
 gpt_relevance_prompt_user = """
 Relevance measures how well the answer addresses the main aspects of the question, based on the context. Consider whether all and only the important aspects are contained in the answer when evaluating relevance. Given the context and question, score the relevance of the answer between one to five stars using the following rating scale:
@@ -159,89 +172,238 @@ question: {question}
 answer: {answer}
 stars:"""
 
-async def execute_eval(row_dict):
+gpt_combined_prompt_sys = """You are an AI assistant. You will be given the definitions of several evaluation metrics for assessing the quality of an answer in a question-answering task. Your job is to compute an accurate evaluation score for each of the requested metrics. Every score must be a single integer value between 1 to 5. You will return only a JSON object that maps each requested metric name to its score, and include no other text or information."""
+gpt_combined_prompt_user = """
+Rate the answer on each of the following metrics from one to five stars, where one star is the worst and five stars is the best.
+similarity: how similar the answer is to the ground truth answer, in both information and content.
+fluency: the quality of the individual sentences in the answer, and whether they are well-written and grammatically correct.
+relevance: how well the answer addresses all and only the important aspects of the question, based on the context.
+groundedness: whether every claim in the answer can be inferred from the context. Give five stars only if the answer is entirely supported by the context.
+
+Requested metrics: {metrics}
+Return a JSON object such as {example}.
+
+context: {context}
+question: {question}
+ground truth: {ground_truth}
+answer: {answer}
+scores:"""
+
+# 指標ごとのプロンプト
+JUDGE_PROMPTS = {
+    "gpt_similarity": (gpt_similarity_prompt_sys, gpt_similarity_prompt_user),
+    "gpt_fluency": (gpt_fluency_prompt_sys, gpt_fluency_prompt_user),
+    "gpt_relevance": (gpt_relevance_prompt_sys, gpt_relevance_prompt_user),
+    "gpt_groundedness": (gpt_groundedness_prompt_sys, gpt_groundedness_prompt_user),
+}
+
+def format_judge_prompt(prompt, row_dict, **kwargs):
+    return prompt.format(question=row_dict["question"], context=row_dict["context"],
+                         ground_truth=row_dict["ground_truth"], answer=row_dict["answer"], **kwargs)
+
+async def judge_metric(metric, row_dict):
+    system, user = JUDGE_PROMPTS[metric]
+    return int(await cached_chat_completion(system, format_judge_prompt(user, row_dict)))
+
+def parse_verdict_score(value):
+    # true や 4.7 を 1 や 4 として受け入れず、読めない値として扱う
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else None
+    if isinstance(value, (int, str)):
+        try:
+            return int(value)
+        except ValueError:
+            return None
+    return None
+
+def parse_combined_verdict(text, metrics):
+    # JSON として読めればそれを使い、読めなければ "relevance: 4" のような記述から拾う。1から5以外は捨てる
+    scores = {}
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if match:
+        try:
+            parsed = json.loads(match.group(0))
+            if isinstance(parsed, dict):
+                scores = {str(key).lower().removeprefix("gpt_"): value for key, value in parsed.items()}
+        except json.JSONDecodeError:
+            pass
+    verdict = {}
+    for metric in metrics:
+        name = metric.removeprefix("gpt_")
+        value = scores.get(name)
+        if value is None:
+            found = re.search(rf"{name}\W*([1-5])\b", text, re.IGNORECASE)
+            value = found.group(1) if found else None
+        value = parse_verdict_score(value)
+        if value is not None and 1 <= value <= 5:
+            verdict[metric] = value
+    return verdict
+
+async def judge_combined(row_dict, metrics):
+    # すべての指標を1回のリクエストで評価する
+    names = [metric.removeprefix("gpt_") for metric in metrics]
+    user = format_judge_prompt(gpt_combined_prompt_user, row_dict, metrics=", ".join(names),
+                               example=json.dumps({name: 3 for name in names}))
+    text = await cached_chat_completion(gpt_combined_prompt_sys, user, max_tokens=10 * len(metrics) + 10,
+                                        is_valid=lambda text: len(parse_combined_verdict(text, metrics)) == len(metrics))
+    return parse_combined_verdict(text, metrics)
+
+def request_row_embeddings(row_dict, embedding_batcher):
+    # ground_truth と answer の埋め込みをバッチャーに登録する。不要な行は None を返す
+    if len(row_dict["ground_truth"])>0 and len(row_dict["answer"])>0:
+        return embedding_batcher.submit(row_dict["ground_truth"]), embedding_batcher.submit(row_dict["answer"])
+    return None
+
+METRIC_NAMES = ("gpt_relevance", "gpt_groundedness", "gpt_similarity", "gpt_fluency", "ada_cosine_similarity")
+
+# 指標ごとの評価状態。失敗または評価対象外の指標は 1 点とする
+METRIC_OK = "ok"
+METRIC_FAILED = "failed"
+METRIC_SKIPPED = "skipped"
+
+def has_failed_metrics(processed_row):
+    return METRIC_FAILED in processed_row.get("status", {}).values()
+
+def count_failed_metrics(each_rows):
+    return sum(list(row.get("status", {}).values()).count(METRIC_FAILED) for row in each_rows)
+
+def raise_if_fatal(error):
+    # API のエラーと判定として読めない応答 (ValueError) だけを指標ごとの失敗として扱う。
+    # 締め切り超過、キャンセル、プログラムの誤りや設定の誤りは行全体を止め、誤った結果を保存しない
+    if not (is_api_error(error) or isinstance(error, ValueError)):
+        raise error
+
+async def score_similarity(embeddings_gt, embeddings_ans):
+    vector_gt, vector_ans = await asyncio.gather(embeddings_gt, embeddings_ans)
+    return cosine_similarity_to_bin(calc_cosine_similarity(vector_gt, vector_ans))
+
+async def execute_eval(row_dict, embeddings=None, previous=None):
+    with metrics.track('row'):
+        return await _execute_eval(row_dict, embeddings, previous)
+
+async def _execute_eval(row_dict, embeddings=None, previous=None):
+    """Evaluates one row. Each metric succeeds or fails on its own and its state is kept in "status".
+
+    Metrics that succeeded in `previous` (an earlier result of the same row) are reused and not sent again.
+    """
+    scores = {metric: 1 for metric in METRIC_NAMES}
+    status = {metric: METRIC_SKIPPED for metric in METRIC_NAMES}
+    previous_status = (previous or {}).get("status", {})
+    for metric in METRIC_NAMES:
+        if previous_status.get(metric) == METRIC_OK:
+            scores[metric] = previous[metric]
+            status[metric] = METRIC_OK
+
     tasks = {}
-    results = {}
-    gpt_relevance = 1
-    gpt_groundedness = 1
-    gpt_similarity = 1
-    gpt_fluency = 1
-    ada_cosine_similarity_score = 1
-
-    selected_config = random.choice(st.session_state['config'])
-    # print(selected_config)
-    # print(st.session_state["AZURE_OPENAI_API_VERSION"])
-    # print(st.session_state["AZURE_OPENAI_DEPLOYMENT_NAME"])
-    # print(st.session_state["AZURE_OPENAI_EMBED_DEPLOYMENT_NAME"])
-    
-    client = AsyncAzureOpenAI(
-        api_key=selected_config["api_key"], #os.getenv("AZURE_OPENAI_API_KEY"), 
-        api_version=st.session_state["AZURE_OPENAI_API_VERSION"],
-        azure_endpoint=selected_config["endpoint"] #os.getenv("AZURE_OPENAI_ENDPOINT")
-    )
-    
-    try:
-        if len(row_dict["answer"])>0:
-            tasks["gpt_similarity"] = asyncio.create_task(
-                chat_completion(client, gpt_similarity_prompt_sys, gpt_similarity_prompt_user.format(question=row_dict["question"], ground_truth=row_dict["ground_truth"],answer=row_dict["answer"]))
-            )
-            tasks["gpt_fluency"] = asyncio.create_task(
-                chat_completion(client, gpt_fluency_prompt_sys, gpt_fluency_prompt_user.format(question=row_dict["question"],answer=row_dict["answer"]))
-            )
-        if len(row_dict["answer"])>0 and len(row_dict["context"])>0:
-            tasks["gpt_relevance"] = asyncio.create_task(
-                chat_completion(client, gpt_relevance_prompt_sys, gpt_relevance_prompt_user.format(question=row_dict["question"], context=row_dict["context"],answer=row_dict["answer"]))
-            )
-            tasks["gpt_groundedness"] = asyncio.create_task(
-                chat_completion(client, gpt_groundedness_prompt_sys, gpt_groundedness_prompt_user.format(context=row_dict["context"],answer=row_dict["answer"]))
-            )
-        if len(row_dict["ground_truth"])>0 and len(row_dict["answer"])>0:
-            tasks["embeddings_gt"] = asyncio.create_task(
-                aget_embeddings(client, row_dict["ground_truth"])
-            )
-            tasks["embeddings_ans"] = asyncio.create_task(
-                aget_embeddings(client, row_dict["answer"])
+    judge_metrics = []
+    if len(row_dict["answer"])>0:
+        judge_metrics += ["gpt_similarity", "gpt_fluency"]
+    if len(row_dict["answer"])>0 and len(row_dict["context"])>0:
+        judge_metrics += ["gpt_relevance", "gpt_groundedness"]
+    judge_metrics = [metric for metric in judge_metrics if status[metric] != METRIC_OK]
+    if JUDGE_MODE == 'combined' and judge_metrics:
+        tasks["gpt_combined"] = asyncio.create_task(judge_combined(row_dict, judge_metrics))
+    else:
+        for metric in judge_metrics:
+            tasks[metric] = asyncio.create_task(judge_metric(metric, row_dict))
+    if status["ada_cosine_similarity"] != METRIC_OK:
+        if embeddings is not None:
+            # バッチでまとめて取得される埋め込みを待つ
+            tasks["ada_cosine_similarity"] = asyncio.create_task(score_similarity(*embeddings))
+        elif len(row_dict["ground_truth"])>0 and len(row_dict["answer"])>0:
+            tasks["ada_cosine_similarity"] = asyncio.create_task(
+                score_similarity(aget_embedding(row_dict["ground_truth"]), aget_embedding(row_dict["answer"]))
             )
 
-        results = await asyncio.gather(*tasks.values())
-        results = dict(zip(tasks.keys(), results))
-
-        if "gpt_similarity" in results:
-            gpt_similarity = int(results["gpt_similarity"])
-        if "gpt_fluency" in results:
-            gpt_fluency = int(results["gpt_fluency"])
-        if "gpt_relevance" in results:
-            gpt_relevance = int(results["gpt_relevance"])
-        if "gpt_groundedness" in results:
-            gpt_groundedness = int(results["gpt_groundedness"])
-        if "embeddings_gt" in results and "embeddings_ans" in results:
-            ada_cosine_similarity_score = cosine_similarity_to_bin(calc_cosine_similarity(results["embeddings_gt"][0], results["embeddings_ans"][0]))
-
-    except ValueError as e:
-        print("ValueError:", e)
-        pass
-    
-    return {"gpt_relevance": gpt_relevance, "gpt_groundedness": gpt_groundedness, "gpt_similarity": gpt_similarity, "gpt_fluency": gpt_fluency, "ada_cosine_similarity": ada_cosine_similarity_score}
-
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-async def chat_completion(client, system, user):
     try:
-        response = await client.chat.completions.create(
-            model=st.session_state["AZURE_OPENAI_DEPLOYMENT_NAME"],
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+    finally:
+        for task in tasks.values():
+            task.cancel()
+    results = dict(zip(tasks.keys(), results))
+    if "gpt_combined" in results:
+        combined = results.pop("gpt_combined")
+        if isinstance(combined, BaseException):
+            raise_if_fatal(combined)
+            print("gpt_combined failed:", combined)
+            combined = {}
+        results.update(combined)
+        # 解析できなかった指標だけ、個別のプロンプトで評価し直す
+        missing = [metric for metric in judge_metrics if metric not in results]
+        results.update(zip(missing, await asyncio.gather(*(judge_metric(metric, row_dict) for metric in missing),
+                                                         return_exceptions=True)))
+
+    # 成功した指標の結果は、他の指標が失敗しても残す
+    for metric, result in results.items():
+        if isinstance(result, BaseException):
+            raise_if_fatal(result)
+            print(f"{metric} failed:", repr(result))
+            metrics.inc('metric_failures_total', metric=metric)
+            status[metric] = METRIC_FAILED
+        else:
+            scores[metric] = int(result)
+            status[metric] = METRIC_OK
+
+    return {**scores, "status": status}
+
+def record_token_usage(operation, response):
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        metrics.inc('prompt_tokens_total', getattr(usage, 'prompt_tokens', 0) or 0, operation=operation)
+        metrics.inc('completion_tokens_total', getattr(usage, 'completion_tokens', 0) or 0, operation=operation)
+
+def get_client(endpoint):
+    # エンドポイントごとのクライアントを使い回し、接続を再利用する
+    return client_pool.get_client(endpoint.config, get_eval_setting("AZURE_OPENAI_API_VERSION"))
+
+def request_options():
+    # 提出ごとの締め切りを超えないように、リクエストのタイムアウトを短くする
+    remaining = remaining_time()
+    if remaining is None:
+        return {}
+    return {"timeout": max(0.1, min(remaining, AZURE_OPENAI_TIMEOUT))}
+
+async def chat_completion(system, user, max_tokens=1):
+    return await retry_call('chat', lambda: _chat_completion_once(system, user, max_tokens))
+
+async def _chat_completion_once(system, user, max_tokens):
+    # 試行ごとに、最も余裕のあるエンドポイントを選ぶ
+    scheduler = get_endpoint_scheduler(get_eval_setting('config'), 'chat')
+    # 失敗はスケジューラーが request_errors_total に数え、retry_call が再試行するので、ここでは出力しない
+    async with scheduler.request(estimate_tokens(system) + estimate_tokens(user) + max_tokens) as endpoint:
+        response = await get_client(endpoint).chat.completions.create(
+            model=get_eval_setting("AZURE_OPENAI_DEPLOYMENT_NAME"),
             messages=[
                 {"role": "system", "content": system},
                 {"role": "user", "content": user},
             ],
-            max_tokens=1,
+            max_tokens=max_tokens,
             temperature=0.0,
+            **request_options(),
         )
+    record_token_usage('chat', response)
 
-    except Exception as e:
-        print(e)
-        raise
-        
     #print("chat_completion: ",response.choices[0].message.content)
-    return response.choices[0].message.content.strip()[:1]
+    # コンテンツフィルターなどで本文がない応答は、判定として読めない応答として扱う
+    content = (response.choices[0].message.content or '').strip()
+    return content[:1] if max_tokens == 1 else content
+
+def is_valid_verdict(verdict):
+    return verdict in ('1', '2', '3', '4', '5')
+
+async def cached_chat_completion(system, user, max_tokens=1, is_valid=is_valid_verdict):
+    # temperature=0.0 なので、同じプロンプトには前回と同じ判定を返す
+    key = verdict_cache.make_key(get_eval_setting("AZURE_OPENAI_DEPLOYMENT_NAME"), system, user)
+    # SQLite の読み書きはワーカースレッドで行い、全ジョブで共有しているイベントループを止めない
+    verdict = await verdict_cache.aget(key)
+    if verdict is None:
+        verdict = await chat_completion(system, user, max_tokens)
+        # 正しい判定だけを保存し、不正な応答はキャッシュしない
+        if is_valid(verdict):
+            await verdict_cache.aput(key, verdict)
+    return verdict
 
 async def _chat_completion_test(system, user):
     try:
@@ -256,16 +418,42 @@ async def _chat_completion_test(system, user):
 
 @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
 def generate_embeddings(client, text, model="text-embedding-3-small"):
-    model=st.session_state["AZURE_OPENAI_EMBED_DEPLOYMENT_NAME"]
+    model=get_eval_setting("AZURE_OPENAI_EMBED_DEPLOYMENT_NAME")
     return client.embeddings.create(input = [text], model=model).data[0].embedding
 
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-async def aget_embeddings(client, text, model="text-embedding-3-small"):
-    model=st.session_state["AZURE_OPENAI_EMBED_DEPLOYMENT_NAME"]
-    data = (
-        await client.embeddings.create(input=[text], model=model)
-    ).data
-    return [d.embedding for d in data]
+async def aget_embeddings(texts, model="text-embedding-3-small"):
+    if isinstance(texts, str):
+        texts = [texts]
+    return await retry_call('embeddings', lambda: _aget_embeddings_once(texts))
+
+async def _aget_embeddings_once(texts):
+    model=get_eval_setting("AZURE_OPENAI_EMBED_DEPLOYMENT_NAME")
+    scheduler = get_endpoint_scheduler(get_eval_setting('config'), 'embeddings')
+    async with scheduler.request(sum(estimate_tokens(text) for text in texts)) as endpoint:
+        response = await get_client(endpoint).embeddings.create(input=texts, model=model, **request_options())
+    record_token_usage('embeddings', response)
+    data = response.data
+    # 入力と同じ順序で返す
+    return [d.embedding for d in sorted(data, key=lambda d: d.index)]
+
+async def aget_cached_embeddings(texts):
+    # キャッシュにないテキストだけを埋め込む
+    deployment = get_eval_setting("AZURE_OPENAI_EMBED_DEPLOYMENT_NAME")
+    # SQLite の読み書きはワーカースレッドで行い、全ジョブで共有しているイベントループを止めない
+    cached = await embedding_cache.aget_many(deployment, texts)
+    missing = [text for text in dict.fromkeys(texts) if text not in cached]
+    if missing:
+        vectors = dict(zip(missing, await aget_embeddings(missing)))
+        await embedding_cache.aput_many(deployment, vectors)
+        cached.update(vectors)
+    return [cached[text] for text in texts]
+
+async def aget_embedding(text):
+    return (await aget_cached_embeddings([text]))[0]
+
+async def embed_texts(texts):
+    # 複数行分のテキストをまとめて1回のリクエストで埋め込む
+    return await aget_cached_embeddings(texts)
 
 def calc_cosine_similarity(v1, v2):
     dot_product = np.dot(v1, v2)
@@ -274,19 +462,24 @@ def calc_cosine_similarity(v1, v2):
     cos = dot_product / (norm_v1 * norm_v2)
     return cos
 
+# コサイン類似度のビンの境界: 0.2未満 -> 1, 0.2以上0.4未満 -> 2, ..., 0.8以上 -> 5
+COSINE_SIMILARITY_BIN_EDGES = np.array([0.2, 0.4, 0.6, 0.8])
+
+def calc_cosine_similarity_batch(m1, m2):
+    # 行ごとのコサイン類似度を一度に計算する。ゼロベクトルを含む行は 0 とする
+    m1 = np.asarray(m1, dtype=np.float64)
+    m2 = np.asarray(m2, dtype=np.float64)
+    dot_products = np.einsum('ij,ij->i', m1, m2)
+    norms = np.linalg.norm(m1, axis=1) * np.linalg.norm(m2, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos = dot_products / norms
+    return np.where(norms > 0, cos, 0.0)
+
+def cosine_similarity_to_bin_batch(cosine_similarities):
+    # 範囲外の値は [0, 1] に丸め（丸め誤差で 1 を超える場合など）、NaN は 0 とみなす
+    cosine_similarities = np.nan_to_num(np.asarray(cosine_similarities, dtype=np.float64), nan=0.0)
+    cosine_similarities = np.clip(cosine_similarities, 0.0, 1.0)
+    return np.digitize(cosine_similarities, COSINE_SIMILARITY_BIN_EDGES) + 1
+
 def cosine_similarity_to_bin(cosine_similarity):
-    # コサイン類似度の値が指定された範囲外の場合はエラーを投げる
-    if cosine_similarity < 0 or cosine_similarity > 1:
-        raise ValueError("コサイン類似度は0から1の範囲内でなければなりません。")
-    
-    # コサイン類似度値をビンに分類
-    if cosine_similarity < 0.2:
-        return 1
-    elif cosine_similarity < 0.4:
-        return 2
-    elif cosine_similarity < 0.6:
-        return 3
-    elif cosine_similarity < 0.8:
-        return 4
-    else:  # 0.8以上1以下
-        return 5
+    return int(cosine_similarity_to_bin_batch([cosine_similarity])[0])
@@ -0,0 +1,128 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+# ヒストグラムのバケットの上限（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(**labels) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        # バケットの上限で近似する
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for upper, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return upper
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """Process-wide counters, gauges and latency histograms of the evaluation pipeline."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Labels], float] = dict()
+        self.gauges: Dict[Tuple[str, Labels], float] = dict()
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = dict()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, _labels(**labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_gauge(self, name: str, amount: float, **labels):
+        key = (name, _labels(**labels))
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _labels(**labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def track(self, name: str, **labels):
+        """Counts the block as in flight while it runs and records its duration and failures."""
+        self.add_gauge(f'{name}_in_flight', 1, **labels)
+        started_at = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.inc(f'{name}_errors_total', status=getattr(e, 'status_code', None) or type(e).__name__, **labels)
+            raise
+        finally:
+            self.add_gauge(f'{name}_in_flight', -1, **labels)
+            self.observe(f'{name}_seconds', time.monotonic() - started_at, **labels)
+
+    def latency_table(self) -> List[dict]:
+        with self._lock:
+            rows = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                rows.append({'metric': name, **dict(labels), 'count': histogram.count,
+                             'mean': round(histogram.sum / histogram.count, 3) if histogram.count else None,
+                             'p50<=': histogram.quantile(0.5), 'p99<=': histogram.quantile(0.99)})
+            return rows
+
+    def counter_table(self) -> List[dict]:
+        with self._lock:
+            return [{'metric': name, **dict(labels), 'value': value}
+                    for (name, labels), value in sorted(list(self.counters.items()) + list(self.gauges.items()))]
+
+    def to_prometheus_text(self, prefix: str = 'leaderboard_eval_') -> str:
+        def format_labels(labels: Labels, extra: Labels = ()) -> str:
+            labels = labels + extra
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f'# TYPE {prefix}{name} {kind}')
+                    for (metric_name, labels), value in sorted(values.items()):
+                        if metric_name == name:
+                            lines.append(f'{prefix}{name}{format_labels(labels)} {value}')
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {prefix}{name} histogram')
+                for (metric_name, labels), histogram in sorted(self.histograms.items()):
+                    if metric_name != name:
+                        continue
+                    cumulative = 0
+                    for upper, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if upper == float('inf') else str(upper)
+                        lines.append(f'{prefix}{name}_bucket{format_labels(labels, (("le", le),))} {cumulative}')
+                    lines.append(f'{prefix}{name}_sum{format_labels(labels)} {histogram.sum}')
+                    lines.append(f'{prefix}{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
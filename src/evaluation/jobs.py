@@ -0,0 +1,215 @@
+import asyncio
+import threading
+import time
+import uuid
+from collections import deque
+from io import BytesIO
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+
+from src.config import (EVAL_MAX_CONCURRENT_JOBS, EVAL_JOB_RETENTION_SECONDS, EVAL_SUBMISSION_DEADLINE_SECONDS,
+                        DEDUPLICATE_ACROSS_PARTICIPANTS)
+from src.evaluation.checkpoint import EvaluationCheckpoint
+from src.evaluation.instrumentation import metrics
+from src.evaluation.resilience import set_deadline
+from src.evaluation.pipeline import (process_csv, build_json_result, validate_csv_columns, iter_csv_chunks,
+                                     InvalidSubmissionError)
+from src.evaluation.settings import set_eval_settings
+from src.submissions.submissions_manager import SingleParticipantSubmissions, get_content_hash
+
+
+class EvaluationJob:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, participant: SingleParticipantSubmissions, submission_bytes: bytes,
+                 submission_name: Optional[str], file_extension: Optional[str], settings: dict,
+                 job_id: Optional[str] = None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.participant = participant
+        self.submission_bytes = submission_bytes
+        self.content_hash = get_content_hash(submission_bytes)
+        self.submission_name = submission_name
+        self.file_extension = file_extension
+        self.settings = settings
+        self.status = self.QUEUED
+        self.completed_rows = 0
+        self.total_rows = 0
+        self.recent_rows: Deque[Tuple[int, dict]] = deque(maxlen=100)
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.checkpoint: Optional[EvaluationCheckpoint] = None
+        # 同じ内容の提出の結果を再利用した場合、その提出の JSON ファイル
+        self.reused_from: Optional[Path] = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (self.DONE, self.FAILED)
+
+    async def on_row_done(self, position: int, processed_row: dict, completed_rows: int, total_rows: int):
+        if self.checkpoint is not None:
+            # ファイルへの書き込みはワーカースレッドで行い、全ジョブで共有しているイベントループを止めない
+            await asyncio.to_thread(self.checkpoint.append_row, position, processed_row)
+        self.completed_rows = completed_rows
+        self.total_rows = total_rows
+        self.recent_rows.append((position, processed_row))
+
+
+class EvaluationJobManager:
+    """Runs evaluation jobs on a long-lived event loop in a background thread.
+
+    Jobs keep running when the submitting browser session goes away; the UI only polls their status.
+    """
+
+    def __init__(self, max_concurrent_jobs: int = EVAL_MAX_CONCURRENT_JOBS):
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self._jobs: Dict[str, EvaluationJob] = dict()
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_jobs)
+            threading.Thread(target=self._loop.run_forever, name='evaluation-jobs', daemon=True).start()
+
+    def submit(self, participant: SingleParticipantSubmissions, submission_bytes: bytes,
+               submission_name: Optional[str], file_extension: Optional[str], settings: dict) -> EvaluationJob:
+        job = EvaluationJob(participant, submission_bytes, submission_name, file_extension, settings)
+        # 同じファイルが評価中、または評価済みなら評価し直さない
+        running = self._find_running(participant, job.content_hash)
+        if running is not None:
+            return running
+        duplicate = participant.find_duplicate(job.content_hash, DEDUPLICATE_ACROSS_PARTICIPANTS)
+        if duplicate is not None:
+            self._reuse_result(job, duplicate)
+            return job
+        # 同じファイルの評価が中断されていれば、新しく評価せずにそれを再開する
+        for resumed in self.resume_pending(participant, settings):
+            if resumed.content_hash == job.content_hash:
+                return resumed
+        job.checkpoint = EvaluationCheckpoint.create(participant.participant_submission_dir, job.job_id,
+                                                     submission_bytes, submission_name, file_extension,
+                                                     job.content_hash)
+        self._start(job)
+        return job
+
+    def _find_running(self, participant: SingleParticipantSubmissions, content_hash: str) -> Optional[EvaluationJob]:
+        with self._lock:
+            for job in self._jobs.values():
+                if (not job.is_finished and job.content_hash == content_hash
+                        and job.participant.participant_name == participant.participant_name):
+                    return job
+        return None
+
+    def _reuse_result(self, job: EvaluationJob, duplicate: Path):
+        job.result = job.participant.load_json_result(duplicate)
+        if duplicate.parts[-2] != job.participant.participant_name:
+            # 他の参加者の提出: 結果を共有する提出としてこの参加者にも登録する
+            job.participant.link_submission(duplicate, job.submission_name)
+        job.reused_from = duplicate
+        job.completed_rows = job.total_rows = len(job.result.get('scores', []))
+        job.status = EvaluationJob.DONE
+        job.finished_at = time.time()
+        metrics.inc('reused_submissions_total')
+        with self._lock:
+            self._forget_old_jobs()
+            self._jobs[job.job_id] = job
+
+    def resume_pending(self, participant: SingleParticipantSubmissions, settings: dict) -> List[EvaluationJob]:
+        """Restarts the participant's checkpointed evaluations that no process is running."""
+        resumed = []
+        for checkpoint in EvaluationCheckpoint.find_pending(participant.participant_submission_dir):
+            with self._lock:
+                if checkpoint.job_id in self._jobs:
+                    continue
+            if not checkpoint.claim():
+                # 他のプロセス（別のインスタンス）が評価中
+                continue
+            meta = checkpoint.load_meta()
+            submission_bytes = checkpoint.load_submission_bytes()
+            content_hash = meta.get('content_hash') or get_content_hash(submission_bytes)
+            # 中断している間に同じファイルが評価された場合は、二重に保存しないようにチェックポイントを破棄する
+            if (self._find_running(participant, content_hash) is not None
+                    or participant.find_duplicate(content_hash, DEDUPLICATE_ACROSS_PARTICIPANTS) is not None):
+                checkpoint.remove()
+                continue
+            job = EvaluationJob(participant, submission_bytes, meta['submission_name'], meta['file_extension'],
+                                settings, job_id=checkpoint.job_id)
+            job.checkpoint = checkpoint
+            self._start(job)
+            resumed.append(job)
+        return resumed
+
+    def _start(self, job: EvaluationJob):
+        self._ensure_started()
+        with self._lock:
+            self._forget_old_jobs()
+            if job.job_id in self._jobs:
+                return
+            self._jobs[job.job_id] = job
+        asyncio.run_coroutine_threadsafe(self._run(job), self._loop)
+
+    def get(self, job_id: str) -> Optional[EvaluationJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_jobs(self) -> List[EvaluationJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _forget_old_jobs(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.is_finished and now - job.finished_at > EVAL_JOB_RETENTION_SECONDS]:
+            del self._jobs[job_id]
+
+    async def _run(self, job: EvaluationJob):
+        async with self._semaphore:
+            metrics.observe('job_queue_wait_seconds', time.time() - job.created_at)
+            job.status = EvaluationJob.RUNNING
+            # このタスクから作られるタスクはすべて、投稿時のセッションの設定と締め切りを使う
+            set_eval_settings(job.settings)
+            set_deadline(EVAL_SUBMISSION_DEADLINE_SECONDS)
+            try:
+                # CSVファイルの読み込み
+                # 列を先に確認し、行は読み込みながら評価に流す
+                validate_csv_columns(BytesIO(job.submission_bytes))
+                data = iter_csv_chunks(BytesIO(job.submission_bytes))
+                # チェックポイントに保存済みの行は評価し直さない
+                finished_rows = None
+                if job.checkpoint is not None:
+                    finished_rows = await asyncio.to_thread(job.checkpoint.load_rows)
+                average_score, each_rows = await process_csv(data, job.on_row_done, finished_rows)
+                job.result = build_json_result(average_score, each_rows)
+                # 評価が終わったら提出ファイルと結果を保存する
+                await asyncio.to_thread(job.participant.add_submission, BytesIO(job.submission_bytes),
+                                        job.submission_name, job.file_extension, job.result, job.content_hash)
+                job.status = EvaluationJob.DONE
+            except InvalidSubmissionError as e:
+                job.error = str(e)
+                job.status = EvaluationJob.FAILED
+            except Exception as e:
+                print("Evaluation job failed:", e)
+                job.error = str(e)
+                job.status = EvaluationJob.FAILED
+            except asyncio.CancelledError:
+                job.error = 'The evaluation was cancelled.'
+                job.status = EvaluationJob.FAILED
+                raise
+            finally:
+                # 失敗した場合もチェックポイントを破棄する。残すと、同じファイルが再提出された後で
+                # 古い評価も再開され、二重に保存されてしまう。再開されるのはプロセスが停止した評価だけ
+                if job.checkpoint is not None:
+                    await asyncio.to_thread(job.checkpoint.remove)
+                job.finished_at = time.time()
+
+
+job_manager = EvaluationJobManager()
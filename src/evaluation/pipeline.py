@@ -0,0 +1,160 @@
+import asyncio
+import time
+from io import BytesIO, StringIO
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from src.config import EVAL_CONCURRENCY, CSV_CHUNK_ROWS, CSV_PREVIEW_ROWS
+from src.evaluation.embedding_batcher import EmbeddingBatcher
+from src.evaluation.instrumentation import metrics
+from src.evaluation.gpteval import (execute_eval, embed_texts, request_row_embeddings, has_failed_metrics,
+                                    count_failed_metrics,
+                                    METRIC_NAMES, METRIC_OK)
+
+# 提出ファイルに必要な列
+REQUIRED_COLUMNS = ("question", "context", "ground_truth", "answer")
+
+# on_row_done(position, processed_row, completed_rows, total_rows)
+RowCallback = Callable[[int, dict, int, int], Awaitable[None]]
+
+
+class InvalidSubmissionError(ValueError):
+    pass
+
+
+def validate_csv_columns(source: Union[BytesIO, StringIO]):
+    """Reads only the header of the CSV and raises InvalidSubmissionError if a required column is missing."""
+    source.seek(0)
+    try:
+        columns = pd.read_csv(source, nrows=0).columns
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+        raise InvalidSubmissionError(f"The submission file is not a valid CSV: {e}") from e
+    finally:
+        source.seek(0)
+    missing = [column for column in REQUIRED_COLUMNS if column not in columns]
+    if missing:
+        raise InvalidSubmissionError(f"The submission file is missing the columns: {', '.join(missing)}")
+
+
+def read_csv_preview(source: Union[BytesIO, StringIO], num_rows: int = CSV_PREVIEW_ROWS) -> pd.DataFrame:
+    source.seek(0)
+    try:
+        return pd.read_csv(source, nrows=num_rows, dtype=str).fillna('')
+    finally:
+        source.seek(0)
+
+
+def iter_csv_chunks(source: Union[BytesIO, StringIO], chunksize: int = CSV_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    """Parses the CSV lazily, `chunksize` rows at a time. Every value is read as a string and blanks become ''."""
+    source.seek(0)
+    try:
+        for chunk in pd.read_csv(source, chunksize=chunksize, dtype=str):
+            yield chunk.fillna('')
+    except (pd.errors.ParserError, UnicodeDecodeError) as e:
+        raise InvalidSubmissionError(f"The submission file is not a valid CSV: {e}") from e
+
+
+async def process_csv(data: Union[pd.DataFrame, Iterable[pd.DataFrame]], on_row_done: Optional[RowCallback] = None,
+                      finished_rows: Optional[Dict[int, dict]] = None, concurrency: int = EVAL_CONCURRENCY,
+                      row_evaluator: Callable[..., Awaitable[dict]] = execute_eval
+                      ) -> Tuple[Dict[str, float], List[dict]]:
+    """Evaluates every row of a submission. Returns the per-metric averages and the per-row scores in CSV order.
+
+    `data` is a DataFrame or an iterable of DataFrame chunks (see iter_csv_chunks); rows start being evaluated
+    as soon as their chunk is parsed, and `total_rows` given to `on_row_done` grows while chunks are read.
+    Rows in `finished_rows` (position -> scores, e.g. from a checkpoint) are reused instead of evaluated; for
+    rows with failed metrics only those metrics are evaluated again.
+    `row_evaluator` is called as row_evaluator(row, embeddings, previous) and defaults to execute_eval.
+    """
+    chunks = [data] if isinstance(data, pd.DataFrame) else data
+    finished_rows = dict(finished_rows or {})
+    # 未完了の行がこれを超えたら、次のチャンクを読む前に完了を待つ
+    max_pending_rows = max(concurrency * 4, CSV_CHUNK_ROWS)
+
+    # 同時に評価する行数を EVAL_CONCURRENCY に制限する
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    # 埋め込みは読み込んだ行の分を先に登録し、複数行まとめてリクエストする
+    embedding_batcher = EmbeddingBatcher(embed_texts)
+
+    async def evaluate_row(position, row, embeddings, previous):
+        queued_at = time.monotonic()
+        async with semaphore:
+            # 同時実行数の空きを待った時間
+            metrics.observe('row_queue_wait_seconds', time.monotonic() - queued_at)
+            return position, await row_evaluator(row, embeddings, previous)
+
+    # 結果は行番号をキーにして保持し、最後に CSV の行順に並べる
+    results: Dict[int, dict] = dict()
+    total_rows = 0
+    completed = 0
+    pending = set()
+
+    async def collect(done_tasks):
+        # 完了した行から順に処理する。失敗した行があっても、完了した行の結果をすべて読んでから例外を送出する
+        nonlocal completed
+        error = None
+        for task in done_tasks:
+            if task.exception() is not None:
+                error = error or task.exception()
+                continue
+            position, processed_row = task.result()
+            results[position] = processed_row
+            completed += 1
+            if on_row_done is not None:
+                await on_row_done(position, processed_row, completed, total_rows)
+        if error is not None:
+            raise error
+
+    try:
+        for chunk in chunks:
+            for _, row in chunk.iterrows():
+                position = total_rows
+                total_rows += 1
+                previous = finished_rows.get(position)
+                if previous is not None and not has_failed_metrics(previous):
+                    # 評価済みの行はそのまま使う
+                    results[position] = previous
+                    completed += 1
+                    continue
+                # 失敗した指標だけを評価し直す
+                need_embeddings = previous is None or previous["status"].get("ada_cosine_similarity") != METRIC_OK
+                embeddings = request_row_embeddings(row, embedding_batcher) if need_embeddings else None
+                pending.add(asyncio.create_task(evaluate_row(position, row, embeddings, previous)))
+            # 読み込んだ行の評価を進める。未完了の行が多すぎる場合は、次のチャンクを読む前に待つ
+            await asyncio.sleep(0)
+            while len(pending) > max_pending_rows:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                await collect(done)
+            done = {task for task in pending if task.done()}
+            pending -= done
+            await collect(done)
+        embedding_batcher.flush()
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            await collect(done)
+    finally:
+        # 途中で失敗した場合は残りの行をキャンセルし、終わるまで待つ
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await embedding_batcher.aclose()
+
+    each_rows = [results[position] for position in range(total_rows)]
+    # 各指標の合計をレコード数で除算して平均を計算
+    record = {key: sum(row.get(key, 0) for row in each_rows) for key in METRIC_NAMES}
+    average_score = {key: round(value / max(total_rows, 1), 3) for key, value in record.items()}
+    return average_score, each_rows
+
+
+def build_json_result(average_score: Dict[str, float], each_rows: List[dict]) -> dict:
+    # JSON用データ
+    return {
+        "scores": each_rows,
+        "average_score": average_score,
+        # record の値の合計を算出
+        "total_score": sum(average_score.values()),
+        # 失敗して最低点になった指標の数（0 でなければ同じファイルの再提出時に評価し直す）
+        "failed_metrics": count_failed_metrics(each_rows),
+    }
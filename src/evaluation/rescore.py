@@ -0,0 +1,119 @@
+import json
+import os
+import sys
+from collections import defaultdict
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from src.config import SUBMISSIONS_DIR, ALLOWED_SUBMISSION_FILE_EXTENSION
+from src.evaluation.embedding_cache import embedding_cache
+from src.evaluation.pipeline import iter_csv_chunks, InvalidSubmissionError
+from src.common.file_store import StoreVersion, atomic_write, file_lock
+from src.submissions.submissions_manager import PARTICIPANT_LOCK_FILENAME, STORE_VERSION_FILENAME
+from src.submissions.row_scores import load_row_scores, resolve_row_scores_path, save_row_scores
+from src.evaluation.gpteval import (calc_cosine_similarity_batch, cosine_similarity_to_bin_batch, count_failed_metrics,
+                                    METRIC_OK)
+
+
+def rescore_cosine_similarity(data: pd.DataFrame, each_rows: list, deployment: str) -> int:
+    """Recomputes ada_cosine_similarity of a whole submission in one pass from cached embeddings.
+
+    Rows whose embeddings are not in the cache keep their stored score. Returns the number of rescored rows.
+    """
+    positions = [position for position, (_, row) in enumerate(data.iterrows())
+                 if len(row["ground_truth"]) > 0 and len(row["answer"]) > 0]
+    ground_truths = [data.iloc[position]["ground_truth"] for position in positions]
+    answers = [data.iloc[position]["answer"] for position in positions]
+    vectors = embedding_cache.get_many(deployment, ground_truths + answers)
+    found = [i for i, (ground_truth, answer) in enumerate(zip(ground_truths, answers))
+             if ground_truth in vectors and answer in vectors]
+    if not found:
+        return 0
+    ground_truth_matrix = np.stack([vectors[ground_truths[i]] for i in found])
+    answer_matrix = np.stack([vectors[answers[i]] for i in found])
+    bins = cosine_similarity_to_bin_batch(calc_cosine_similarity_batch(ground_truth_matrix, answer_matrix))
+    for i, score in zip(found, bins):
+        each_rows[positions[i]]["ada_cosine_similarity"] = int(score)
+        if "status" in each_rows[positions[i]]:
+            each_rows[positions[i]]["status"]["ada_cosine_similarity"] = METRIC_OK
+    return len(found)
+
+
+def find_linked_summaries(submissions_dir: Path) -> Dict[str, List[Path]]:
+    """Summaries that share another submission's result, by the "participant/file.json" they link to."""
+    linked = defaultdict(list)
+    for summary_path in submissions_dir.glob('*/*.json'):
+        linked_from = json.loads(summary_path.read_text()).get('linked_from')
+        if linked_from is not None:
+            linked[linked_from].append(summary_path)
+    return linked
+
+
+def _update_linked_summary(link_path: Path, source_summary: dict):
+    with file_lock(link_path.parent.joinpath(PARTICIPANT_LOCK_FILENAME)):
+        summary = json.loads(link_path.read_text())
+        for key in ("average_score", "total_score", "failed_metrics", "row_count"):
+            if key in source_summary:
+                summary[key] = source_summary[key]
+        with atomic_write(link_path, 'w') as f:
+            f.write(json.dumps(summary, indent=2) + '\n')
+
+
+def rescore_submission(json_path: Path, deployment: str, linked_summaries: Iterable[Path] = ()) -> int:
+    """Rescores a submission, and updates the totals of the summaries in linked_summaries that share its result."""
+    submission_path = json_path.with_suffix(f'.{ALLOWED_SUBMISSION_FILE_EXTENSION}')
+    if not submission_path.is_file():
+        return 0
+    # アプリの各インスタンスと同じく、参加者のロックを取ってから書き換える
+    with file_lock(json_path.parent.joinpath(PARTICIPANT_LOCK_FILENAME)):
+        rescored = _rescore_submission(json_path, submission_path, deployment)
+    if rescored:
+        # 同じ行ごとの評価結果を共有している提出の合計スコアも揃える
+        source_summary = json.loads(json_path.read_text())
+        for link_path in linked_summaries:
+            _update_linked_summary(link_path, source_summary)
+        # 実行中のアプリに変更を知らせる
+        StoreVersion(json_path.parent.parent.joinpath(STORE_VERSION_FILENAME)).bump()
+    return rescored
+
+
+def _rescore_submission(json_path: Path, submission_path: Path, deployment: str) -> int:
+    json_result = json.loads(json_path.read_text())
+    # 行ごとの評価結果は .npz に分けて保存されている（古い提出は JSON の "scores" に含まれる）
+    row_scores_path = resolve_row_scores_path(json_path, json_result) if "scores_file" in json_result else None
+    each_rows = load_row_scores(row_scores_path) if row_scores_path else json_result["scores"]
+    # 評価時と同じく、すべての値を文字列として読み込む（数値のような回答も len() できるように）
+    try:
+        chunks = list(iter_csv_chunks(BytesIO(submission_path.read_bytes())))
+    except InvalidSubmissionError:
+        return 0
+    data = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+    if len(data) != len(each_rows):
+        return 0
+    rescored = rescore_cosine_similarity(data, each_rows, deployment)
+    if rescored:
+        average_score = json_result["average_score"]
+        average_score["ada_cosine_similarity"] = round(
+            sum(row["ada_cosine_similarity"] for row in each_rows) / max(len(each_rows), 1), 3)
+        json_result["total_score"] = sum(average_score.values())
+        json_result["failed_metrics"] = count_failed_metrics(each_rows)
+        if row_scores_path:
+            save_row_scores(row_scores_path, each_rows)
+        # 一時ファイルに書いてから置き換える（他のプロセスが書きかけを読まず、ポーリングでも変更を検出できる）
+        with atomic_write(json_path, 'w') as f:
+            f.write(json.dumps(json_result, indent=2) + '\n')
+    return rescored
+
+
+if __name__ == '__main__':
+    # 例: python -m src.evaluation.rescore <埋め込みのデプロイ名>
+    deployment_name = sys.argv[1] if len(sys.argv) > 1 else os.getenv("AZURE_OPENAI_EMBED_DEPLOYMENT_NAME")
+    linked_summaries = find_linked_summaries(SUBMISSIONS_DIR)
+    for participant_dir in sorted(x for x in SUBMISSIONS_DIR.iterdir() if x.is_dir()):
+        for submission_json in sorted(participant_dir.glob('*.json')):
+            print(submission_json, rescore_submission(submission_json, deployment_name,
+                                                      linked_summaries.get('/'.join(submission_json.parts[-2:]), ())))
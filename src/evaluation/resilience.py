@@ -0,0 +1,151 @@
+import asyncio
+import random
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import httpx
+import openai
+
+from src.config import (RETRY_MAX_ATTEMPTS, RETRY_MIN_WAIT, RETRY_MAX_WAIT, CIRCUIT_FAILURE_THRESHOLD,
+                        CIRCUIT_OPEN_SECONDS)
+from src.evaluation.instrumentation import metrics
+
+T = TypeVar('T')
+
+# 応答のないエラーのうち、再試行すれば成功しうるもの（接続エラーとタイムアウト）
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.APITimeoutError, httpx.TransportError)
+
+_deadline: ContextVar[Optional[float]] = ContextVar('eval_deadline', default=None)
+
+
+class DeadlineExceededError(TimeoutError):
+    pass
+
+
+def set_deadline(seconds: Optional[float]):
+    """Sets the deadline of the current context (e.g. one submission) to `seconds` from now."""
+    _deadline.set(None if seconds is None else time.monotonic() + seconds)
+
+
+def remaining_time() -> Optional[float]:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def check_deadline():
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceededError("The evaluation deadline was exceeded.")
+
+
+def get_status_code(error: Exception) -> Optional[int]:
+    return getattr(error, 'status_code', None)
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Returns the backoff the service asked for, in seconds, if the error is a 429."""
+    if get_status_code(error) != 429:
+        return None
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    for header in ('retry-after-ms', 'retry-after'):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            seconds = float(value)
+        except ValueError:
+            continue
+        return seconds / 1000 if header == 'retry-after-ms' else seconds
+    return 1.0
+
+
+def is_api_error(error: BaseException) -> bool:
+    """Whether the error came from the service or the connection to it, rather than from this program."""
+    return isinstance(error, (openai.APIError, httpx.HTTPError))
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, DeadlineExceededError):
+        return False
+    status_code = get_status_code(error)
+    if status_code is None:
+        # 接続エラーやタイムアウトには status_code がない。それ以外（プログラムの誤りなど）は再試行しない
+        return isinstance(error, TRANSIENT_ERRORS)
+    return status_code in (408, 409, 429) or status_code >= 500
+
+
+def is_endpoint_failure(error: Exception) -> bool:
+    """Whether the error says the endpoint itself is unhealthy (as opposed to throttling or a bad request)."""
+    status_code = get_status_code(error)
+    if status_code is None:
+        return isinstance(error, TRANSIENT_ERRORS)
+    return status_code >= 500
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures and lets a single probe through after `open_seconds`."""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, open_seconds: float = CIRCUIT_OPEN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+
+    def seconds_until_allowed(self, now: float) -> float:
+        if self.state == self.CLOSED:
+            return 0.0
+        if self.state == self.OPEN:
+            return max(0.0, self.opened_at + self.open_seconds - now)
+        # 半開状態では、試しに送ったリクエストの結果を待つ
+        return self.open_seconds
+
+    def on_acquire(self, now: float):
+        if self.state == self.OPEN and now >= self.opened_at + self.open_seconds:
+            self.state = self.HALF_OPEN
+
+    def release_probe(self):
+        # 試しに送ったリクエストが結果なしで終わった場合は、すぐに次の試行を許す
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.opened_at = -self.open_seconds
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+
+    def record_failure(self, now: float):
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = now
+
+
+async def retry_call(operation: str, call: Callable[[], Awaitable[T]], max_attempts: int = RETRY_MAX_ATTEMPTS,
+                     min_wait: float = RETRY_MIN_WAIT, max_wait: float = RETRY_MAX_WAIT) -> T:
+    """Calls `call` until it succeeds, `max_attempts` is reached or the deadline of the context passes.
+
+    Throttled calls are retried right away: the scheduler keeps the throttled endpoint in cooldown for its
+    Retry-After and routes the retry to another endpoint or waits. Other failures back off exponentially.
+    """
+    for attempt in range(1, max_attempts + 1):
+        check_deadline()
+        try:
+            return await call()
+        except Exception as e:
+            if attempt == max_attempts or not is_retryable(e):
+                raise
+            if get_retry_after(e) is not None:
+                wait = random.uniform(0, min_wait)
+            else:
+                wait = random.uniform(0, min(max_wait, min_wait * 2 ** attempt))
+            remaining = remaining_time()
+            if remaining is not None and wait >= remaining:
+                raise DeadlineExceededError("The evaluation deadline was exceeded.") from e
+            metrics.inc('retries_total', operation=operation)
+            await asyncio.sleep(wait)
@@ -0,0 +1,28 @@
+from contextvars import ContextVar
+from typing import Optional
+
+import streamlit as st
+
+# Values of st.session_state that the evaluation reads
+EVAL_SETTING_NAMES = ('config', 'AZURE_OPENAI_DEPLOYMENT_NAME', 'AZURE_OPENAI_EMBED_DEPLOYMENT_NAME',
+                      'AZURE_OPENAI_API_VERSION')
+
+_eval_settings: ContextVar[Optional[dict]] = ContextVar('eval_settings', default=None)
+
+
+def snapshot_eval_settings() -> dict:
+    """Copies the evaluation settings out of the current Streamlit session."""
+    return {name: st.session_state[name] for name in EVAL_SETTING_NAMES}
+
+
+def set_eval_settings(settings: dict):
+    """Sets the settings for the current context. asyncio tasks created afterwards inherit them."""
+    _eval_settings.set(settings)
+
+
+def get_eval_setting(name: str):
+    # バックグラウンドのジョブでは st.session_state が使えないため、スナップショットを優先する
+    settings = _eval_settings.get()
+    if settings is None:
+        return st.session_state[name]
+    return settings[name]
@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+from src.common.sqlite_store import SqliteBlobStore
+from src.config import VERDICT_CACHE_FILE, VERDICT_CACHE_MEMORY_ITEMS
+
+
+class VerdictCache:
+    """Durable cache of judge verdicts.
+
+    The judge runs with temperature=0.0, so a verdict is fully determined by the deployment and the rendered
+    system and user prompts. Those are hashed into the key, so the cache is shared by all participants.
+    """
+
+    def __init__(self, db_file: Path, max_memory_items: int = VERDICT_CACHE_MEMORY_ITEMS):
+        self.store = SqliteBlobStore(db_file, 'verdicts')
+        self.max_memory_items = max_memory_items
+        self._lock = threading.Lock()
+        self._memory: 'OrderedDict[str, str]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(deployment: str, system: str, user: str) -> str:
+        return hashlib.sha256(f'{deployment}\0{system}\0{user}'.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        verdict = self._get_from_memory(key)
+        if verdict is not None:
+            return verdict
+        return self._load(key, self.store.get_many([key]).get(key))
+
+    async def aget(self, key: str) -> Optional[str]:
+        """Like get, but reads SQLite in a worker thread so the event loop is not blocked."""
+        verdict = self._get_from_memory(key)
+        if verdict is not None:
+            return verdict
+        return self._load(key, (await asyncio.to_thread(self.store.get_many, [key])).get(key))
+
+    def _get_from_memory(self, key: str) -> Optional[str]:
+        with self._lock:
+            verdict = self._memory.get(key)
+            if verdict is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+            return verdict
+
+    def _load(self, key: str, blob: Optional[bytes]) -> Optional[str]:
+        with self._lock:
+            if blob is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            verdict = blob.decode()
+            self._remember(key, verdict)
+            return verdict
+
+    def put(self, key: str, verdict: str):
+        with self._lock:
+            self._remember(key, verdict)
+        self.store.put_many({key: verdict.encode()})
+
+    async def aput(self, key: str, verdict: str):
+        """Like put, but commits to SQLite in a worker thread so the event loop is not blocked."""
+        with self._lock:
+            self._remember(key, verdict)
+        await asyncio.to_thread(self.store.put_many, {key: verdict.encode()})
+
+    def _remember(self, key: str, verdict: str):
+        self._memory[key] = verdict
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def clear_memory(self):
+        """Empties the in-memory tier; the SQLite tier is kept."""
+        with self._lock:
+            self._memory.clear()
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'memory_items': len(self._memory),
+            }
+
+
+verdict_cache = VerdictCache(VERDICT_CACHE_FILE)
@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from src.common.sqlite_store import SqliteBlobStore
+from src.evaluation.client_pool import client_pool
+from src.evaluation.embedding_cache import embedding_cache
+from src.evaluation.gpteval import execute_eval
+from src.evaluation.instrumentation import metrics
+from src.evaluation.pipeline import process_csv
+from src.evaluation.settings import set_eval_settings
+from src.evaluation.verdict_cache import verdict_cache
+from src.examples.fake_azure_openai import FakeAzureOpenAIServer, FakeAzureOpenAIProfile
+
+
+def generate_submission(num_rows: int, run_id: str) -> pd.DataFrame:
+    # run_id を含めて、キャッシュにヒットしない行を作る
+    return pd.DataFrame([{
+        'question': f'What is item {i} of run {run_id}?',
+        'context': f'Item {i} of run {run_id} is a sample document used for benchmarking. ' * 5,
+        'ground_truth': f'Item {i} of run {run_id} is a sample document.',
+        'answer': f'It is sample document number {i} of run {run_id}.',
+    } for i in range(num_rows)])
+
+
+async def run_benchmark(data: pd.DataFrame, concurrency: int) -> dict:
+    row_latencies: List[float] = []
+
+    async def timed_execute_eval(row, embeddings, previous=None):
+        started_at = time.perf_counter()
+        try:
+            return await execute_eval(row, embeddings, previous)
+        finally:
+            row_latencies.append(time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    try:
+        await process_csv(data, concurrency=concurrency, row_evaluator=timed_execute_eval)
+    finally:
+        await client_pool.aclose_loop_clients()
+    elapsed = time.perf_counter() - started_at
+    return {
+        'rows_per_sec': len(data) / elapsed,
+        'p50_row_latency': float(np.percentile(row_latencies, 50)) if row_latencies else None,
+        'p99_row_latency': float(np.percentile(row_latencies, 99)) if row_latencies else None,
+        'elapsed': elapsed,
+    }
+
+
+def count_retries() -> float:
+    # 再試行されずに失敗した応答やエンドポイントの切り替えもあるので、応答の数ではなくクライアント側の回数を数える
+    return sum(value for (name, _), value in list(metrics.counters.items()) if name == 'retries_total')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks process_csv against local fake Azure OpenAI endpoints.')
+    parser.add_argument('--rows', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--endpoints', type=int, default=3)
+    parser.add_argument('--median-latency', type=float, default=0.3)
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--rate-429', type=float, default=0.02)
+    parser.add_argument('--rate-5xx', type=float, default=0.005)
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--rpm', type=float, default=100000, help='Quota per endpoint given to the scheduler')
+    parser.add_argument('--tpm', type=float, default=10000000, help='Quota per endpoint given to the scheduler')
+    args = parser.parse_args()
+
+    # 実際のキャッシュを汚さないように、一時ディレクトリを使う
+    cache_dir = Path(tempfile.mkdtemp(prefix='leaderboard-benchmark-'))
+
+    profile = FakeAzureOpenAIProfile(args.median_latency, args.latency_sigma, args.rate_429, args.rate_5xx,
+                                     args.retry_after)
+    print('concurrency,rows,rows_per_sec,p50_row_latency,p99_row_latency,requests,throttled_429,errors_5xx,retries')
+    for concurrency in args.concurrency:
+        # 前の実行のキャッシュにヒットしないように、実行ごとに空のキャッシュを使う
+        run_cache_dir = Path(tempfile.mkdtemp(dir=cache_dir))
+        embedding_cache.store = SqliteBlobStore(run_cache_dir / 'embeddings.db', 'embeddings')
+        verdict_cache.store = SqliteBlobStore(run_cache_dir / 'verdicts.db', 'verdicts')
+        embedding_cache.clear_memory()
+        verdict_cache.clear_memory()
+        servers = [FakeAzureOpenAIServer(profile=profile).start() for _ in range(args.endpoints)]
+        set_eval_settings({
+            'config': [{'endpoint': server.endpoint, 'api_key': 'fake', 'rpm': args.rpm, 'tpm': args.tpm,
+                        'embed_rpm': args.rpm, 'embed_tpm': args.tpm} for server in servers],
+            'AZURE_OPENAI_DEPLOYMENT_NAME': 'fake-chat',
+            'AZURE_OPENAI_EMBED_DEPLOYMENT_NAME': 'fake-embeddings',
+            'AZURE_OPENAI_API_VERSION': '2024-02-01',
+        })
+        data = generate_submission(args.rows, f'c{concurrency}-{time.time()}')
+        retries_before = count_retries()
+        result = asyncio.run(run_benchmark(data, concurrency))
+        counters = {name: sum(server.counters[name] for server in servers) for name in servers[0].counters}
+        retries = int(count_retries() - retries_before)
+        print(f"{concurrency},{args.rows},{result['rows_per_sec']:.2f},{result['p50_row_latency']:.3f},"
+              f"{result['p99_row_latency']:.3f},{counters['requests']},{counters['throttled_429']},"
+              f"{counters['errors_5xx']},{retries}")
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -77,7 +77,9 @@ class ExampleEvaluator(Evaluator):
             return self._evaluate_prediction_dict(predictions)
         else:
             return None
-        
+
+    def evaluate_summary(self, summary: dict) -> Tuple[Metric, ...]:
+        return self._evaluate_prediction_dict(summary)
 
     def _evaluate_prediction_dict(self, predictions: Dict[str, int]) -> Tuple[Metric, ...]:
         # preds_array = np.array([predictions.get(k, 1-self.true_label_dict[k])
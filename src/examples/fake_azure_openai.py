@@ -0,0 +1,153 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+import numpy as np
+
+_deployment_path = re.compile(r'^/openai/deployments/(?P<deployment>[^/]+)/(?P<operation>chat/completions|embeddings)$')
+
+
+class FakeAzureOpenAIProfile:
+    """Behaviour of the fake server: log-normal latency and injected failures."""
+
+    def __init__(self, median_latency: float = 0.3, latency_sigma: float = 0.5, rate_429: float = 0.0,
+                 rate_5xx: float = 0.0, retry_after: float = 1.0, embedding_dimensions: int = 64):
+        self.median_latency = median_latency
+        self.latency_sigma = latency_sigma
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.embedding_dimensions = embedding_dimensions
+
+    def sample_latency(self) -> float:
+        return self.median_latency * float(np.random.lognormal(0.0, self.latency_sigma))
+
+
+class FakeAzureOpenAIServer(ThreadingHTTPServer):
+    """Local stand-in for the Azure OpenAI chat completions and embeddings endpoints."""
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, port: int = 0, profile: Optional[FakeAzureOpenAIProfile] = None):
+        super().__init__(('127.0.0.1', port), _FakeAzureOpenAIHandler)
+        self.profile = profile or FakeAzureOpenAIProfile()
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {'requests': 0, 'chat': 0, 'embeddings': 0, 'embedding_inputs': 0,
+                                         'throttled_429': 0, 'errors_5xx': 0}
+
+    @property
+    def endpoint(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def start(self) -> 'FakeAzureOpenAIServer':
+        threading.Thread(target=self.serve_forever, name=f'fake-azure-openai-{self.endpoint}', daemon=True).start()
+        return self
+
+
+class _FakeAzureOpenAIHandler(BaseHTTPRequestHandler):
+    server: FakeAzureOpenAIServer
+    # クライアントの keep-alive 接続を使えるようにする
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: Optional[Dict[str, str]] = None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        match = _deployment_path.match(self.path.split('?')[0])
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if match is None:
+            self._send_json(404, {'error': {'code': 'NotFound', 'message': 'Unknown path'}})
+            return
+        profile = self.server.profile
+        self.server.count('requests')
+        time.sleep(profile.sample_latency())
+
+        draw = random.random()
+        if draw < profile.rate_429:
+            self.server.count('throttled_429')
+            self._send_json(429, {'error': {'code': '429', 'message': 'Rate limit is exceeded.'}},
+                            {'Retry-After': str(profile.retry_after),
+                             'retry-after-ms': str(int(profile.retry_after * 1000))})
+            return
+        if draw < profile.rate_429 + profile.rate_5xx:
+            self.server.count('errors_5xx')
+            self._send_json(500, {'error': {'code': 'InternalServerError', 'message': 'Injected failure.'}})
+            return
+
+        if match.group('operation') == 'embeddings':
+            self._send_embeddings(match.group('deployment'), body)
+        else:
+            self._send_chat_completion(match.group('deployment'), body)
+
+    def _send_chat_completion(self, deployment: str, body: dict):
+        self.server.count('chat')
+        # プロンプトから決まる疑似的な評価値を返す
+        prompt = json.dumps(body.get('messages', []))
+        digest = hashlib.sha256(prompt.encode()).digest()
+        if body.get('max_tokens', 1) > 1:
+            names = ('similarity', 'fluency', 'relevance', 'groundedness')
+            content = json.dumps({name: digest[i] % 5 + 1 for i, name in enumerate(names)})
+        else:
+            content = str(digest[0] % 5 + 1)
+        prompt_tokens = len(prompt) // 4
+        self._send_json(200, {
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': deployment,
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': 1, 'total_tokens': prompt_tokens + 1},
+        })
+
+    def _send_embeddings(self, deployment: str, body: dict):
+        texts = body.get('input', [])
+        if isinstance(texts, str):
+            texts = [texts]
+        self.server.count('embeddings')
+        self.server.count('embedding_inputs', len(texts))
+        data = []
+        for index, text in enumerate(texts):
+            # 同じテキストには同じベクトルを返す
+            seed = int.from_bytes(hashlib.sha256(str(text).encode()).digest()[:4], 'little')
+            vector = np.random.default_rng(seed).random(self.server.profile.embedding_dimensions)
+            data.append({'object': 'embedding', 'index': index, 'embedding': vector.tolist()})
+        tokens = sum(len(str(text)) // 4 + 1 for text in texts)
+        self._send_json(200, {'object': 'list', 'data': data, 'model': deployment,
+                              'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Azure OpenAI endpoints.')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--median-latency', type=float, default=0.3, help='Median latency in seconds')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='Sigma of the log-normal latency')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Fraction of requests answered with 429')
+    parser.add_argument('--rate-5xx', type=float, default=0.0, help='Fraction of requests answered with 500')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After sent with 429, in seconds')
+    args = parser.parse_args()
+    server = FakeAzureOpenAIServer(args.port, FakeAzureOpenAIProfile(args.median_latency, args.latency_sigma,
+                                                                     args.rate_429, args.rate_5xx,
+                                                                     args.retry_after))
+    print(f'Serving fake Azure OpenAI on {server.endpoint}')
+    server.serve_forever()
@@ -0,0 +1,192 @@
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from src.config import SUBMISSIONS_WATCH_MODE, SUBMISSIONS_POLL_INTERVAL
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+CREATED = 'created'
+MODIFIED = 'modified'
+DELETED = 'deleted'
+
+# (種類, 参加者名, 提出の JSON ファイル。参加者のディレクトリ自体の変更の場合は None)
+ChangeListener = Callable[[str, str, Optional[Path]], None]
+
+
+class _WatchdogHandler(FileSystemEventHandler):
+    def __init__(self, watcher: 'SubmissionsWatcher'):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_created(self, event):
+        self.watcher.notify(CREATED, Path(event.src_path), event.is_directory)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.notify(MODIFIED, Path(event.src_path), False)
+
+    def on_deleted(self, event):
+        self.watcher.notify(DELETED, Path(event.src_path), event.is_directory)
+
+    def on_moved(self, event):
+        self.watcher.notify(DELETED, Path(event.src_path), event.is_directory)
+        self.watcher.notify(CREATED, Path(event.dest_path), event.is_directory)
+
+
+class SubmissionsWatcher:
+    """Reports new, changed and deleted submission JSON files under the submissions directory.
+
+    Uses inotify (through watchdog) when available. Otherwise a background thread compares the directories'
+    modification times every poll_interval seconds and lists only the directories that changed. Polling
+    therefore sees files that are created, deleted or replaced by a rename, but not files rewritten in place.
+    """
+
+    def __init__(self, submissions_dir: Path, listener: ChangeListener, mode: str = SUBMISSIONS_WATCH_MODE,
+                 poll_interval: float = SUBMISSIONS_POLL_INTERVAL):
+        if mode not in ('auto', 'inotify', 'poll'):
+            raise ValueError(f"Unknown watch mode: {mode}")
+        if mode == 'inotify' and Observer is None:
+            raise RuntimeError("The 'inotify' watch mode requires the watchdog package")
+        self.submissions_dir = submissions_dir
+        self.listener = listener
+        self.mode = 'inotify' if mode == 'auto' and Observer is not None else 'poll' if mode == 'auto' else mode
+        self.poll_interval = poll_interval
+        self._observer = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        # ポーリング用: ディレクトリの更新時刻と、その中の JSON ファイルの更新時刻
+        self._dir_mtimes: Dict[Path, float] = dict()
+        self._file_mtimes: Dict[Path, Dict[Path, float]] = dict()
+        self._poll_lock = threading.Lock()
+
+    def start(self):
+        # inotify の場合も、他のマシンによる変更を poll() で取り込めるように現在の状態を記録しておく
+        self._snapshot_all()
+        if self.mode == 'inotify':
+            self._observer = Observer()
+            self._observer.schedule(_WatchdogHandler(self), str(self.submissions_dir), recursive=True)
+            self._observer.daemon = True
+            self._observer.start()
+        else:
+            self._thread = threading.Thread(target=self._poll_loop, name='submissions-watcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+
+    def _classify(self, path: Path, is_directory: bool) -> Optional[Tuple[str, Optional[Path]]]:
+        if path.parent == self.submissions_dir and is_directory:
+            return path.parts[-1], None
+        if path.parent.parent == self.submissions_dir and not is_directory and path.suffix == '.json':
+            return path.parts[-2], path
+        return None
+
+    def notify(self, kind: str, path: Path, is_directory: bool):
+        classified = self._classify(path, is_directory)
+        if classified is None:
+            return
+        try:
+            self.listener(kind, *classified)
+        except Exception as e:
+            print(f"Failed to apply change {kind} {path}:", e)
+
+    def _list_dir(self, directory: Path) -> Dict[Path, float]:
+        entries = dict()
+        for path in directory.iterdir():
+            try:
+                if path.suffix == '.json' and path.is_file():
+                    entries[path] = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _snapshot_all(self):
+        self._dir_mtimes[self.submissions_dir] = self.submissions_dir.stat().st_mtime
+        for participant_dir in self.submissions_dir.iterdir():
+            if participant_dir.is_dir():
+                self._dir_mtimes[participant_dir] = participant_dir.stat().st_mtime
+                self._file_mtimes[participant_dir] = self._list_dir(participant_dir)
+
+    def _poll_loop(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except OSError as e:
+                print("Failed to check the submissions directory:", e)
+
+    def poll(self):
+        """Checks the directories' modification times once, and reports the changes in those that changed."""
+        with self._poll_lock:
+            self._poll()
+
+    def _poll(self):
+        mtime = self.submissions_dir.stat().st_mtime
+        if mtime != self._dir_mtimes.get(self.submissions_dir):
+            self._dir_mtimes[self.submissions_dir] = mtime
+            participant_dirs = {x for x in self.submissions_dir.iterdir() if x.is_dir()}
+            for participant_dir in set(self._file_mtimes).difference(participant_dirs):
+                del self._file_mtimes[participant_dir]
+                self._dir_mtimes.pop(participant_dir, None)
+                self.notify(DELETED, participant_dir, True)
+            for participant_dir in participant_dirs.difference(self._file_mtimes):
+                self._file_mtimes[participant_dir] = dict()
+                self.notify(CREATED, participant_dir, True)
+
+        for participant_dir, files in list(self._file_mtimes.items()):
+            try:
+                mtime = participant_dir.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if mtime == self._dir_mtimes.get(participant_dir):
+                continue
+            self._dir_mtimes[participant_dir] = mtime
+            current = self._list_dir(participant_dir)
+            for path in set(files).difference(current):
+                self.notify(DELETED, path, False)
+            for path, file_mtime in current.items():
+                if path not in files:
+                    self.notify(CREATED, path, False)
+                elif file_mtime != files[path]:
+                    self.notify(MODIFIED, path, False)
+            self._file_mtimes[participant_dir] = current
+
+
+def make_index_listener(results_index) -> ChangeListener:
+    """Applies the reported changes to a ResultsIndex."""
+    def listener(kind: str, participant: str, json_path: Optional[Path]):
+        if json_path is None:
+            if kind == DELETED:
+                results_index.remove_participant(participant)
+        elif kind == DELETED:
+            results_index.remove_submission(participant, json_path.parts[-1])
+        else:
+            try:
+                results_index.add_submission_file(json_path)
+            except ValueError:
+                # 書き込み途中のファイル。書き終わった時の変更通知で登録される
+                pass
+    return listener
+
+
+_watchers: Dict[Path, SubmissionsWatcher] = dict()
+_watchers_lock = threading.Lock()
+
+
+def watch_submissions(submissions_dir: Path, results_index) -> SubmissionsWatcher:
+    """Starts (once per process) keeping results_index in sync with changes made to submissions_dir."""
+    with _watchers_lock:
+        watcher = _watchers.get(submissions_dir)
+        if watcher is None:
+            watcher = SubmissionsWatcher(submissions_dir, make_index_listener(results_index))
+            watcher.start()
+            _watchers[submissions_dir] = watcher
+        return watcher
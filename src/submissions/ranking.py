@@ -0,0 +1,55 @@
+import bisect
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from src.submissions.submission_record import SubmissionRecord
+
+
+class Ranking:
+    """Every participant's best submission, kept ordered by score (best first) and then by submission time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._order: List[tuple] = []
+        self._entries: Dict[str, Tuple[tuple, SubmissionRecord]] = dict()
+
+    @staticmethod
+    def _sort_key(record: SubmissionRecord) -> tuple:
+        score = -record.result.value if record.result.higher_is_better() else record.result.value
+        return score, record.submitted_at, record.participant_name
+
+    def update(self, record: SubmissionRecord) -> bool:
+        """Records a submission. Returns True if it became the participant's best one."""
+        key = self._sort_key(record)
+        with self._lock:
+            current = self._entries.get(record.participant_name)
+            if current is not None:
+                if current[0] <= key:
+                    return False
+                del self._order[bisect.bisect_left(self._order, current[0])]
+            bisect.insort(self._order, key)
+            self._entries[record.participant_name] = (key, record)
+            return True
+
+    def remove(self, participant_name: str):
+        with self._lock:
+            current = self._entries.pop(participant_name, None)
+            if current is not None:
+                del self._order[bisect.bisect_left(self._order, current[0])]
+
+    def get_best(self, participant_name: str) -> Optional[SubmissionRecord]:
+        current = self._entries.get(participant_name)
+        return None if current is None else current[1]
+
+    def rank(self, participant_name: str) -> Optional[int]:
+        """1-based rank of the participant, None if they have no results."""
+        with self._lock:
+            current = self._entries.get(participant_name)
+            return None if current is None else bisect.bisect_left(self._order, current[0]) + 1
+
+    def top(self, k: Optional[int] = None) -> List[SubmissionRecord]:
+        with self._lock:
+            return [self._entries[key[2]][1] for key in self._order[:k]]
+
+    def __len__(self) -> int:
+        return len(self._order)
@@ -0,0 +1,192 @@
+import json
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from src.config import RESULTS_INDEX_FILE
+
+
+_INSERT_SUBMISSION = ('INSERT OR REPLACE INTO submissions (participant, submission_file, submission_name, submitted_at, '
+                      'total_score, average_score, row_count, content_hash, failed_metrics) '
+                      'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+
+class ResultsIndex:
+    """SQLite index of the submissions' scores: one row per (participant, submission).
+
+    It is written whenever a submission is added, and can be rebuilt from the files in the submissions
+    directory at any time.
+    """
+
+    def __init__(self, db_file: Path):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.db_file), check_same_thread=False, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('''CREATE TABLE IF NOT EXISTS submissions (
+                                      participant TEXT NOT NULL,
+                                      submission_file TEXT NOT NULL,
+                                      submission_name TEXT NOT NULL,
+                                      submitted_at TEXT NOT NULL,
+                                      total_score REAL NOT NULL,
+                                      average_score TEXT NOT NULL,
+                                      row_count INTEGER NOT NULL,
+                                      content_hash TEXT,
+                                      failed_metrics INTEGER,
+                                      PRIMARY KEY (participant, submission_file))''')
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(submissions)')]
+            for column, column_type in (('content_hash', 'TEXT'), ('failed_metrics', 'INTEGER')):
+                if column not in columns:
+                    # 以前の形式で作られたインデックス
+                    connection.execute(f'ALTER TABLE submissions ADD COLUMN {column} {column_type}')
+            connection.execute('CREATE INDEX IF NOT EXISTS submissions_content_hash ON submissions (content_hash)')
+            # 提出が追加されるたびに増えるバージョン番号（表示のキャッシュの無効化に使う）
+            connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            connection.execute("INSERT OR IGNORE INTO meta VALUES ('version', 0)")
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    @staticmethod
+    def _to_summary(row: sqlite3.Row) -> dict:
+        summary = dict(row)
+        summary['submitted_at'] = datetime.fromisoformat(summary['submitted_at'])
+        summary['average_score'] = json.loads(summary['average_score'])
+        return summary
+
+    @staticmethod
+    def _to_values(participant: str, submission_file: str, submission_name: str, submitted_at: datetime,
+                   json_result: dict) -> tuple:
+        return (participant, submission_file, submission_name, submitted_at.isoformat(),
+                json_result.get('total_score', 0), json.dumps(json_result.get('average_score', {})),
+                json_result.get('row_count', len(json_result.get('scores', []))), json_result.get('content_hash'),
+                json_result.get('failed_metrics'))
+
+    @classmethod
+    def _to_values_from_file(cls, json_path: Path) -> tuple:
+        """Reads a submission's JSON file, which lives in the participant's directory."""
+        # 循環 import を避けるため、ここで読み込む
+        from src.submissions.submissions_manager import SingleParticipantSubmissions
+
+        json_result = json.loads(json_path.read_text())
+        return cls._to_values(json_path.parts[-2], json_path.parts[-1],
+                              SingleParticipantSubmissions.get_submission_name_from_path(json_path),
+                              SingleParticipantSubmissions.get_datetime_from_path(json_path), json_result)
+
+    def add_submission(self, participant: str, submission_file: str, submission_name: str,
+                       submitted_at: datetime, json_result: dict) -> bool:
+        """json_result is the submission's summary (or, for older submissions, its full result with 'scores').
+
+        Returns False if the submission was already indexed with the same values.
+        """
+        return self._add_values(self._to_values(participant, submission_file, submission_name, submitted_at,
+                                                json_result))
+
+    def add_submission_file(self, json_path: Path) -> bool:
+        """Indexes a submission from its JSON file, which lives in the participant's directory."""
+        return self._add_values(self._to_values_from_file(json_path))
+
+    def _add_values(self, values: tuple) -> bool:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                existing = connection.execute('SELECT * FROM submissions WHERE participant = ? AND submission_file = ?',
+                                              values[:2]).fetchone()
+                if existing is not None and tuple(existing) == values:
+                    return False
+                connection.execute(_INSERT_SUBMISSION, values)
+                self._bump_version(connection)
+        return True
+
+    def remove_submission(self, participant: str, submission_file: str):
+        self._remove('DELETE FROM submissions WHERE participant = ? AND submission_file = ?',
+                     (participant, submission_file))
+
+    def remove_participant(self, participant: str):
+        self._remove('DELETE FROM submissions WHERE participant = ?', (participant,))
+
+    def _remove(self, statement: str, parameters: tuple):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                if connection.execute(statement, parameters).rowcount:
+                    self._bump_version(connection)
+
+    @staticmethod
+    def _bump_version(connection: sqlite3.Connection):
+        connection.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+    def get_version(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._connect().execute('SELECT 1 FROM submissions LIMIT 1').fetchone() is None
+
+    def get_participants(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._connect().execute('SELECT DISTINCT participant FROM submissions')]
+
+    def get_submissions(self, participant: str) -> List[dict]:
+        with self._lock:
+            rows = self._connect().execute('SELECT * FROM submissions WHERE participant = ? ORDER BY submitted_at',
+                                           (participant,)).fetchall()
+        return [self._to_summary(row) for row in rows]
+
+    def find_by_content_hash(self, content_hash: str, participant: Optional[str] = None) -> Optional[dict]:
+        """The earliest submission with the given content hash (of the given participant, if any) whose metrics
+        were all evaluated successfully."""
+        query = 'SELECT * FROM submissions WHERE content_hash = ? AND failed_metrics = 0'
+        parameters = (content_hash,)
+        if participant is not None:
+            query += ' AND participant = ?'
+            parameters += (participant,)
+        with self._lock:
+            row = self._connect().execute(query + ' ORDER BY submitted_at LIMIT 1', parameters).fetchone()
+        return None if row is None else self._to_summary(row)
+
+    def get_all_submissions(self) -> List[dict]:
+        with self._lock:
+            rows = self._connect().execute('SELECT * FROM submissions ORDER BY submitted_at').fetchall()
+        return [self._to_summary(row) for row in rows]
+
+    def rebuild(self, submissions_dir: Path) -> int:
+        """Replaces the index with the submissions found on disk. Returns the number of indexed submissions."""
+        json_paths = [json_path for participant_dir in sorted(x for x in submissions_dir.iterdir() if x.is_dir())
+                      for json_path in sorted(participant_dir.iterdir())
+                      if json_path.is_file() and json_path.suffix == '.json']
+        rows = []
+        for json_path in json_paths:
+            try:
+                rows.append(self._to_values_from_file(json_path))
+            except (ValueError, OSError) as e:
+                print(f"Skipping {json_path}:", e)
+        # 削除と再登録を 1 トランザクションで行い、他のプロセスが空や途中の索引を読まないようにする
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('DELETE FROM submissions')
+                connection.executemany(_INSERT_SUBMISSION, rows)
+                self._bump_version(connection)
+        return len(rows)
+
+results_index = ResultsIndex(RESULTS_INDEX_FILE)
+
+
+if __name__ == '__main__':
+    # 例: python -m src.submissions.results_index rebuild
+    from src.config import SUBMISSIONS_DIR
+
+    if sys.argv[1:] != ['rebuild']:
+        print('usage: python -m src.submissions.results_index rebuild')
+        sys.exit(1)
+    print(f'Indexed {results_index.rebuild(SUBMISSIONS_DIR)} submissions')
@@ -0,0 +1,73 @@
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from src.common.file_store import atomic_write
+
+# 行ごとの評価結果（"status" は指標ごとの状態）を列ごとの配列として .npz に保存する
+ROW_SCORES_SUFFIX = '.scores.npz'
+_STATUS_PREFIX = 'status:'
+_STATUS_LABELS = 'status_labels'
+_MISSING_STATUS = -1
+
+
+def get_row_scores_path(summary_path: Path) -> Path:
+    return summary_path.with_name(summary_path.stem + ROW_SCORES_SUFFIX)
+
+
+def resolve_row_scores_path(summary_path: Path, summary: dict) -> Path:
+    """The row scores file of a stored summary, which may link to another participant's submission."""
+    if 'linked_from' in summary:
+        summary_path = summary_path.parent.parent.joinpath(summary['linked_from'])
+    return summary_path.with_name(summary['scores_file'])
+
+
+def save_row_scores(path: Path, each_rows: List[dict]):
+    score_names = list(dict.fromkeys(key for row in each_rows for key in row if key != 'status'))
+    status_names = list(dict.fromkeys(key for row in each_rows for key in row.get('status', {})))
+    status_labels = sorted({status for row in each_rows for status in row.get('status', {}).values()})
+    label_codes = {label: code for code, label in enumerate(status_labels)}
+
+    columns = dict()
+    for name in score_names:
+        values = [row.get(name) for row in each_rows]
+        if all(isinstance(value, int) for value in values):
+            columns[name] = np.asarray(values, dtype=np.int16)
+        else:
+            columns[name] = np.asarray([np.nan if value is None else value for value in values], dtype=np.float32)
+    for name in status_names:
+        columns[_STATUS_PREFIX + name] = np.asarray(
+            [label_codes.get(row.get('status', {}).get(name), _MISSING_STATUS) for row in each_rows], dtype=np.int8)
+    columns[_STATUS_LABELS] = np.asarray(status_labels, dtype=str)
+    with atomic_write(path) as f:
+        np.savez(f, **columns)
+
+
+def load_score_columns(path: Path) -> Dict[str, np.ndarray]:
+    """Loads the per-row scores as one array per metric (and per metric status, as codes into 'status_labels')."""
+    with np.load(path, allow_pickle=False) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def load_row_scores(path: Path) -> List[dict]:
+    """Loads the per-row scores back into the list of dicts that the evaluation produced."""
+    columns = load_score_columns(path)
+    status_labels = columns.pop(_STATUS_LABELS).tolist()
+    status_columns = {name[len(_STATUS_PREFIX):]: columns.pop(name)
+                      for name in list(columns) if name.startswith(_STATUS_PREFIX)}
+    row_count = len(next(iter(columns.values()), next(iter(status_columns.values()), [])))
+
+    each_rows = [dict() for _ in range(row_count)]
+    for name, values in columns.items():
+        for row, value in zip(each_rows, values.tolist()):
+            if not (isinstance(value, float) and np.isnan(value)):
+                row[name] = value
+    if status_columns:
+        for row in each_rows:
+            row['status'] = dict()
+        for name, codes in status_columns.items():
+            for row, code in zip(each_rows, codes.tolist()):
+                if code != _MISSING_STATUS:
+                    row['status'][name] = status_labels[code]
+    return each_rows
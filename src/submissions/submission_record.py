@@ -0,0 +1,39 @@
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+from src.evaluation.metric import Metric
+
+
+class SubmissionRecord:
+    """What the views need to know about one submission, parsed once when the submission is first seen."""
+
+    __slots__ = ('participant_name', 'path', 'submission_name', 'submitted_at', 'result', 'total_score',
+                 'average_score', 'row_count')
+
+    def __init__(self, participant_name: str, path: Path, submission_name: str, submitted_at: datetime,
+                 result: Optional[Metric], total_score: Optional[float] = None,
+                 average_score: Optional[Dict[str, float]] = None, row_count: Optional[int] = None):
+        self.participant_name = participant_name
+        self.path = path
+        self.submission_name = submission_name
+        self.submitted_at = submitted_at
+        self.result = result
+        self.total_score = total_score
+        self.average_score = average_score or {}
+        self.row_count = row_count
+
+    @classmethod
+    def from_summary(cls, participant_name: str, path: Path, summary: dict, result: Optional[Metric]):
+        """Builds the record of an indexed submission (see ResultsIndex.get_submissions)."""
+        return cls(participant_name, path, summary['submission_name'], summary['submitted_at'], result,
+                   summary['total_score'], summary['average_score'], summary['row_count'])
+
+    def matches(self, summary: dict) -> bool:
+        """Whether the record is still up to date with the submission's indexed summary."""
+        return (self.submitted_at == summary['submitted_at'] and self.total_score == summary['total_score']
+                and self.average_score == summary['average_score'] and self.row_count == summary['row_count'])
+
+    def __repr__(self):
+        return (f"SubmissionRecord(participant_name={self.participant_name!r}, "
+                f"submission_name={self.submission_name!r}, submitted_at={self.submitted_at}, result={self.result})")
@@ -3,7 +3,7 @@ from typing import Union, Optional, Callable
 
 import streamlit as st
 
-from src.config import ADMIN_USERNAME
+from src.config import ADMIN_USERNAME, PROGRESS_UPDATE_INTERVAL
 from src.submissions.submissions_manager import SubmissionManager, SingleParticipantSubmissions
 
 import pandas as pd
@@ -16,7 +16,11 @@ from src.config import (SUBMISSIONS_DIR, EVALUATOR_CLASS, EVALUATOR_KWARGS, PASS
                         ARGON2_KWARGS, ALLOWED_SUBMISSION_FILE_EXTENSION, MAX_NUM_USERS, ADMIN_USERNAME)
 from src.evaluation.evaluator import Evaluator
 import base64
-from src.evaluation.gpteval import execute_eval
+from src.evaluation.jobs import job_manager, EvaluationJob
+from src.evaluation.settings import snapshot_eval_settings
+from src.display.progress_reporter import ProgressReporter
+from src.evaluation.pipeline import validate_csv_columns, read_csv_preview, InvalidSubmissionError
+import time
 
 import random
 import os
@@ -31,6 +35,8 @@ class SubmissionSidebar:
         self.submission_validator = submission_validator
         self.participant: SingleParticipantSubmissions = None
         self.file_uploader_key = f"file upload {username}"
+        self.job_id_key = f"evaluation job {username}"
+        self.resume_checked_key = f"resume checked {username}"
 
     def init_participant(self):
         self.submission_manager.add_participant(self.username, exists_ok=True)
@@ -54,11 +60,13 @@ class SubmissionSidebar:
             else:
                 submission_failed = True
                 with st.spinner('Uploading your submission...'):
-                    # CSVファイルの読み込み
-                    data = pd.read_csv(submission_io_stream)
-                    st.session_state['data'] = data.replace(np.nan, '', regex=True)
-                    st.write(st.session_state['data'])
-                    submission_failed = False
+                    # 列だけを確認し、先頭の数行だけを表示する
+                    try:
+                        validate_csv_columns(submission_io_stream)
+                        st.write(read_csv_preview(submission_io_stream))
+                        submission_failed = False
+                    except InvalidSubmissionError as e:
+                        st.sidebar.error(str(e))
 
                     # if self.submission_validator is None or self.submission_validator(submission_io_stream):
                     #     print("😎upload_submission", submission_io_stream, submission_name)
@@ -68,94 +76,84 @@ class SubmissionSidebar:
                     st.sidebar.error("Upload failed. The submission file is not valid.")
                 else:
                     st.sidebar.success("Upload successful!")
-        
+
         # OKボタンを設置
         if st.button('Start evaluation', type="primary"):
             if submission_io_stream is None:
                 st.error('Please upload a submission file.')
             else:
-                # # CSVデータの処理
-                json_result = asyncio.run(self._main("start"))
-                self._upload_submission(submission_io_stream, submission_name, json_result)
-                
-                # 'scores'のデータをDataFrameに変換
-                scores_df = pd.DataFrame(json_result['scores'])
-                # CSVにエンコード
-                csvfile = scores_df.to_csv(index=False)
-                b64 = base64.b64encode(csvfile.encode()).decode()  # Base64エンコード
-
-                # ダウンロードリンクを作成
-                href = f'<a href="data:file/csv;base64,{b64}" download="results.csv">Download Results</a>'
-                st.markdown(href, unsafe_allow_html=True)
-
-    def _upload_submission(self, io_stream: Union[BytesIO, StringIO], submission_name: Optional[str] = None, json_result=None):
-        self.init_participant()
-        # CSV のコピー
-        # JSONを保存するのはここ TODO
-        self.participant.add_submission(io_stream, submission_name, self.submission_file_extension, json_result)
-    
-    # main coroutine
-    async def _main(self, some_argument):
-        # 非同期処理の実行
-        average_score, each_rows = await self.process_csv(st.session_state['data'])
-        
+                try:
+                    validate_csv_columns(submission_io_stream)
+                except InvalidSubmissionError as e:
+                    st.error(str(e))
+                else:
+                    # 評価はバックグラウンドのジョブとして実行する
+                    self.init_participant()
+                    job = job_manager.submit(self.participant, submission_io_stream.getvalue(), submission_name,
+                                             self.submission_file_extension, snapshot_eval_settings())
+                    st.session_state[self.job_id_key] = job.job_id
+
+        job_id = st.session_state.get(self.job_id_key)
+        if (job_id is None and not st.session_state.get(self.resume_checked_key)
+                and self.submission_manager.participant_exists(self.username)):
+            # 再起動などで中断された評価があれば、チェックポイントから再開する。ディレクトリを読むのはセッションごとに1回だけ
+            st.session_state[self.resume_checked_key] = True
+            resumed = job_manager.resume_pending(self.submission_manager.get_participant(self.username),
+                                                 snapshot_eval_settings())
+            if resumed:
+                job_id = resumed[-1].job_id
+                st.session_state[self.job_id_key] = job_id
+        job = job_manager.get(job_id) if job_id is not None else None
+        if job is not None:
+            self._show_job(job)
+
+    def _show_job(self, job: EvaluationJob):
+        if not job.is_finished:
+            self._show_running_job(job)
+            return
+
+        reporter = ProgressReporter()
+        reporter.update(job.completed_rows, job.total_rows, list(job.recent_rows))
+        if job.status == EvaluationJob.FAILED:
+            reporter.fail()
+            st.error(f'Evaluation failed: {job.error}')
+            return
+
+        reporter.complete()
+        if job.reused_from is not None:
+            st.info('This file has already been evaluated, so its stored result is shown instead of evaluating it '
+                    'again.')
+        self._show_result(job.result)
+
+    @st.experimental_fragment(run_every=PROGRESS_UPDATE_INTERVAL)
+    def _show_running_job(self, job: EvaluationJob):
+        # 評価中は進捗の部分だけを定期的に再実行し、ページ全体は描き直さない
+        if job.is_finished:
+            # 終わったらページ全体を再実行して、結果と更新されたリーダーボードを表示する
+            st.rerun()
+        reporter = ProgressReporter()
+        reporter.update(job.completed_rows, job.total_rows, list(job.recent_rows))
+        if job.status == EvaluationJob.QUEUED:
+            reporter.status_text.text('Waiting for other evaluations to finish...')
+
+    def _show_result(self, json_result):
         # 解析結果の表示
-        #if st.session_state['result'] is not None:
-        if average_score is not None:
-            # Show result
-            st.write('Evaluation result:')
-            st.write("average_score:")
-            st.write(average_score)
-            # record の値の合計を算出
-            total_score = sum(average_score.values())
-            st.write(f"total_score: {total_score:.3f}")
-
-            # JSON用データ
-            data = {
-                "scores": each_rows,
-                "average_score": average_score,
-                "total_score": total_score
-            }
-
-            return data
-
-
-    # データ処理関数
-    async def process_csv(self, data):
-        # 進捗バーの初期化
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-        status1 = st.status("Evaluating...", expanded=True)
-        average_score = 0
-        # データ行数
-        total_rows = len(data)
-        record = {"gpt_relevance": 0, "gpt_groundedness": 0, "gpt_similarity": 0, "gpt_fluency": 0, "ada_cosine_similarity": 0}
-        #st.session_state['count'] = total_rows
-
-        each_rows = []
-        # 各行ごとに処理
-        for i, row in data.iterrows():
-            # ステータスの更新
-            status_text.text(f'Evaluating: {i + 1}/{total_rows} rows')
-
-            # 行のデータを処理
-            #processed_row = await self._execute_eval_test(row)
-            processed_row = await execute_eval(row)
-            each_rows.append(processed_row)
-            status1.write(str(i) + " : " + str(processed_row))
-            # 進捗バーの更新
-            progress_bar.progress((i + 1) / total_rows)
-
-            # return_score の各キーに対して、record の対応するキーの値に加算
-            for key, value in processed_row.items():
-                if key in record:
-                    record[key] += value
-
-        # record の各キーをレコード数で除算して平均を計算
-        if total_rows > 0:
-            average_score = {key: round(value / total_rows, 3) for key, value in record.items()}
-
-        # ステータスのクリア
-        status_text.text('Evaluation complete')
-        status1.update(label="Evaluation complete!", state="complete", expanded=False)
-        return average_score, each_rows
+        st.write('Evaluation result:')
+        st.write("average_score:")
+        st.write(json_result['average_score'])
+        st.write(f"total_score: {json_result['total_score']:.3f}")
+
+        # 'scores'のデータをDataFrameに変換し、行ごとの結果は表で表示する
+        scores_df = pd.DataFrame(json_result['scores'])
+        if 'status' in scores_df.columns:
+            # 指標ごとの評価状態 (dict) は、CSV でも読めるように指標ごとの列に展開する
+            statuses = [status if isinstance(status, dict) else {} for status in scores_df.pop('status')]
+            scores_df = scores_df.join(pd.DataFrame(statuses, index=scores_df.index).add_suffix('_status'))
+        st.dataframe(scores_df, use_container_width=True)
+        # CSVにエンコード
+        csvfile = scores_df.to_csv(index=False)
+        b64 = base64.b64encode(csvfile.encode()).decode()  # Base64エンコード
+
+        # ダウンロードリンクを作成
+        href = f'<a href="data:file/csv;base64,{b64}" download="results.csv">Download Results</a>'
+        st.markdown(href, unsafe_allow_html=True)
@@ -1,28 +1,58 @@
 import base64
+import hashlib
 import shutil
+import threading
 from datetime import datetime
 from io import BytesIO, StringIO
 from pathlib import Path
 from typing import List, Tuple, Dict, Union, Optional
 
+from src.common.file_store import StoreVersion, atomic_write, file_lock
 from src.evaluation.evaluator import Evaluator
 from src.evaluation.metric import Metric
 from src.common.utils import remove_illegal_filename_characters, is_legal_filename
+from src.submissions.change_detection import watch_submissions
+from src.submissions.ranking import Ranking
+from src.submissions.results_index import ResultsIndex
+from src.submissions.row_scores import get_row_scores_path, load_row_scores, resolve_row_scores_path, save_row_scores
+from src.submissions.submission_record import SubmissionRecord
 import json
 
+def get_content_hash(submission_bytes: bytes) -> str:
+    """Fingerprint of a submission file, used to recognise identical resubmissions."""
+    return hashlib.sha256(submission_bytes).hexdigest()
+
+
+# 提出ディレクトリを共有するすべてのプロセスが、提出を変更するたびに増やすバージョン番号のファイル
+STORE_VERSION_FILENAME = '.version'
+# 参加者のディレクトリの提出を書き換えるプロセスが取得するロックのファイル
+PARTICIPANT_LOCK_FILENAME = '.lock'
+
+
 class SingleParticipantSubmissions:
     _datetime_format = '%Y-%m-%dT%H-%M-%S-%f'
 
-    def __init__(self, participant_submission_dir: Path):
+    def __init__(self, participant_submission_dir: Path, results_index: Optional[ResultsIndex] = None,
+                 ranking: Optional[Ranking] = None):
         self.participant_submission_dir = participant_submission_dir
+        self.results_index = results_index
         self._create_participant_dir()
         self.participant_name = self.participant_submission_dir.parts[-1]
-        self.results: Dict[Path: Tuple[Metric, ...]] = dict()
+        # 提出ごとに一度だけ作る、名前・日時・スコアを解析済みのレコード
+        self.records: Dict[Path, SubmissionRecord] = dict()
+        # 結果が追加されるたびに更新する最良の結果（ranking が無い場合は参加者ごとに持つ）
+        self.ranking = ranking if ranking is not None else Ranking()
+        # 全セッションで共有されるため、提出の追加とレコードの読み書きはこのロックの下で行う
+        self._lock = threading.RLock()
+        self.store_version = StoreVersion(participant_submission_dir.parent.joinpath(STORE_VERSION_FILENAME))
 
     def _create_participant_dir(self):
         self.participant_submission_dir.mkdir(parents=True, exist_ok=True)
 
     def get_submissions(self) -> List[Path]:
+        if self.results_index is not None:
+            return [self.participant_submission_dir.joinpath(x['submission_file'])
+                    for x in self.results_index.get_submissions(self.participant_name)]
         # 参加者の提出ディレクトリ（participant_submission_dir）内のすべてのファイルパスをリストとして返す
         # .iterdir() メソッドを使用してディレクトリ内のすべてのエントリを反復処理し、
         # その中でファイルであるものをフィルタリングしてリストに含める
@@ -30,8 +60,8 @@ class SingleParticipantSubmissions:
         return [x for x in self.participant_submission_dir.iterdir() if x.is_file() and x.suffix == '.json']
 
     @classmethod
-    def _add_timestamp_to_string(cls, input_string: str) -> str:
-        return input_string + '_' + datetime.now().strftime(cls._datetime_format)
+    def _add_timestamp_to_string(cls, input_string: str, timestamp: Optional[datetime] = None) -> str:
+        return input_string + '_' + (timestamp or datetime.now()).strftime(cls._datetime_format)
 
     @classmethod
     def get_submission_name_from_path(cls, filepath: Path) -> str:
@@ -45,93 +75,275 @@ class SingleParticipantSubmissions:
         return datetime.strptime(datetime_part, cls._datetime_format)
 
     def add_submission(self, io_stream: Union[BytesIO, StringIO], submission_name: Optional[str] = None,
-                       file_type_extension: Optional[str] = None, json_result = None):
+                       file_type_extension: Optional[str] = None, json_result = None,
+                       content_hash: Optional[str] = None):
         
-        file_safe_submission_name = base64.urlsafe_b64encode(submission_name.encode()).decode()
-        file_safe_submission_name = self._add_timestamp_to_string(file_safe_submission_name or '')
-        file_type_extension = f'.{file_type_extension}' if file_type_extension else ''
-        submission_filename = file_safe_submission_name + file_type_extension
-        submission_path = self.participant_submission_dir.joinpath(submission_filename)
+        # 同じ参加者の提出は、他のプロセス（別のインスタンス）とも同時に書き込まない
+        with self._lock, file_lock(self.participant_submission_dir.joinpath(PARTICIPANT_LOCK_FILENAME)):
+            submitted_at = datetime.now()
+            file_safe_submission_name = self._make_file_safe_submission_name(submission_name, submitted_at)
+            file_type_extension = f'.{file_type_extension}' if file_type_extension else ''
+            submission_filename = file_safe_submission_name + file_type_extension
+            submission_path = self.participant_submission_dir.joinpath(submission_filename)
+
+            # 各ファイルは一時ファイルに書いてから置き換えるので、他のプロセスが書きかけのファイルを読むことはない
+            with atomic_write(submission_path) as f:
+                io_stream.seek(0)
+                shutil.copyfileobj(io_stream, f)
+
+            # 行ごとの評価結果は列ごとの配列として保存し、JSON には集計値だけを書く
+            row_scores_path = get_row_scores_path(
+                self.participant_submission_dir.joinpath(file_safe_submission_name + '.json'))
+            save_row_scores(row_scores_path, json_result.get('scores', []))
+            summary = self.make_summary(json_result, submission_name, submitted_at, row_scores_path.parts[-1],
+                                        content_hash)
+            self._write_summary(file_safe_submission_name, submission_name, submitted_at, summary)
+        # 他のインスタンスに変更を知らせる
+        self.store_version.bump()
+
+    def link_submission(self, source_summary_path: Path, submission_name: str) -> Path:
+        """Adds a submission that shares the stored files and result of another participant's submission."""
+        source_summary = json.loads(source_summary_path.read_text())
+        with self._lock, file_lock(self.participant_submission_dir.joinpath(PARTICIPANT_LOCK_FILENAME)):
+            submitted_at = datetime.now()
+            file_safe_submission_name = self._make_file_safe_submission_name(submission_name, submitted_at)
+            summary = {
+                **source_summary,
+                "submission_name": submission_name,
+                "submitted_at": submitted_at.isoformat(),
+                # 提出ディレクトリからの相対パス
+                "linked_from": source_summary.get(
+                    'linked_from', '/'.join(source_summary_path.parts[-2:])),
+            }
+            summary_path = self._write_summary(file_safe_submission_name, submission_name, submitted_at, summary)
+        self.store_version.bump()
+        return summary_path
 
-        with submission_path.open('wb') as f:
-            io_stream.seek(0)
-            shutil.copyfileobj(io_stream, f)
+    def _make_file_safe_submission_name(self, submission_name: str, submitted_at: datetime) -> str:
+        file_safe_submission_name = base64.urlsafe_b64encode(submission_name.encode()).decode()
+        return self._add_timestamp_to_string(file_safe_submission_name or '', submitted_at)
 
-        # 保存するデータ
+    def _write_summary(self, file_safe_submission_name: str, submission_name: str, submitted_at: datetime,
+                       summary: dict) -> Path:
+        # JSON がある提出だけが読み込まれるため、JSON は最後に書く
         jsonfilename = file_safe_submission_name + '.json'
-        # ファイル名を指定してJSONファイルとして保存
-        with open(self.participant_submission_dir.joinpath(jsonfilename), 'w') as jsonl_file:
-            jsonl_file.write(json.dumps(json_result, indent=2) + '\n')
+        summary_path = self.participant_submission_dir.joinpath(jsonfilename)
+        with atomic_write(summary_path, 'w') as jsonl_file:
+            jsonl_file.write(json.dumps(summary, indent=2) + '\n')
+
+        if self.results_index is not None:
+            self.results_index.add_submission(self.participant_name, jsonfilename, submission_name, submitted_at,
+                                              summary)
+        return summary_path
+
+    @staticmethod
+    def make_summary(json_result: dict, submission_name: str, submitted_at: datetime, row_scores_file: str,
+                     content_hash: Optional[str] = None) -> dict:
+        return {
+            "submission_name": submission_name,
+            "submitted_at": submitted_at.isoformat(),
+            "row_count": len(json_result.get('scores', [])),
+            "average_score": json_result.get('average_score', {}),
+            "total_score": json_result.get('total_score', 0),
+            "scores_file": row_scores_file,
+            "content_hash": content_hash,
+            "failed_metrics": json_result.get('failed_metrics'),
+        }
+
+    @staticmethod
+    def load_json_result(summary_path: Path) -> dict:
+        """Loads a stored submission's full result, in the form the evaluation produced it."""
+        summary = json.loads(summary_path.read_text())
+        if 'scores_file' not in summary:
+            return summary
+        return {
+            "scores": load_row_scores(resolve_row_scores_path(summary_path, summary)),
+            "average_score": summary['average_score'],
+            "total_score": summary['total_score'],
+        }
+
+    def find_duplicate(self, content_hash: str, across_participants: bool = False) -> Optional[Path]:
+        """The summary file of an already evaluated submission with the same content, preferring this participant's.
+
+        Submissions with failed metrics are not returned, so that resubmitting the file retries those metrics.
+        """
+        if self.results_index is None:
+            return None
+        duplicate = self.results_index.find_by_content_hash(content_hash, self.participant_name)
+        if duplicate is None and across_participants:
+            duplicate = self.results_index.find_by_content_hash(content_hash)
+        if duplicate is None:
+            return None
+        return self.participant_submission_dir.parent.joinpath(duplicate['participant'], duplicate['submission_file'])
+
+    @property
+    def results(self) -> Dict[Path, Metric]:
+        with self._lock:
+            return {path: record.result for path, record in self.records.items()}
 
     def clear_results(self):
-        self.results.clear()
+        with self._lock:
+            self.records.clear()
+            self.ranking.remove(self.participant_name)
+
+    def _add_record(self, record: SubmissionRecord):
+        self.records[record.path] = record
+        if record.result is not None:
+            self.ranking.update(record)
 
     def update_results(self, evaluator: Evaluator):
+        with self._lock:
+            self._update_results(evaluator)
+
+    def get_records(self) -> List[SubmissionRecord]:
+        """A snapshot of the records that can be read while other sessions update them."""
+        with self._lock:
+            return list(self.records.values())
+
+    def _update_results(self, evaluator: Evaluator):
+        if self.results_index is not None:
+            # インデックスの集計値から評価し、提出ファイルは読まない
+            summaries = {self.participant_submission_dir.joinpath(summary['submission_file']): summary
+                         for summary in self.results_index.get_submissions(self.participant_name)}
+            # 削除・変更された提出のレコードを取り除き、最良の結果を残りから求め直す
+            stale = [path for path, record in self.records.items()
+                     if path not in summaries or not record.matches(summaries[path])]
+            if stale:
+                for path in stale:
+                    del self.records[path]
+                self.ranking.remove(self.participant_name)
+                for record in self.records.values():
+                    if record.result is not None:
+                        self.ranking.update(record)
+            for submission, summary in summaries.items():
+                if submission in self.records:
+                    continue
+                result = evaluator.evaluate_summary(summary)
+                if result is None:
+                    result = evaluator.evaluate(submission)
+                self._add_record(SubmissionRecord.from_summary(self.participant_name, submission, summary, result))
+            return
+
         # get_submissions メソッドを呼び出して、参加者の提出ファイルすべてのリストを取得
         submissions = self.get_submissions()
             
         # 提出ファイルリストを反復処理
         for submission in submissions:
-            # 提出ファイルが既に results 辞書に含まれているかをチェック
-            if submission in self.results:
+            # 提出ファイルが既にレコードになっているかをチェック
+            if submission in self.records:
                 # 既に含まれている場合、処理をスキップして次の提出ファイルに進む
                 continue
 
-            # 提出ファイルが results 辞書に含まれていない場合、evaluate メソッドを呼び出して評価を実行
-            # 評価結果を results 辞書に追加
-            self.results[submission] = evaluator.evaluate(submission)
+            # 含まれていない場合、evaluate メソッドを呼び出して評価を実行し、レコードを追加
+            self._add_record(SubmissionRecord(self.participant_name, submission,
+                                              self.get_submission_name_from_path(submission),
+                                              self.get_datetime_from_path(submission),
+                                              evaluator.evaluate(submission)))
 
     def get_best_result(self) -> Tuple[Path, Tuple[Metric, ...]]:
-        # return None if not self.results else max([(path, result) for path, result in self.results.items()],
-        #                                          key=lambda x: x[1])
-        if not self.results:
-            return None
-        else:
-            items = self.results.items()  # self.resultsのキーと値のペアを取得
-            pairs = [(path, result) for path, result in items]  # リスト内包表記でペアのリストを作成
-            max_pair = max(pairs, key=lambda x: x[1])   # F1の値を基準に最大値を持つペアを見つける
-            return max_pair  # 最大のペアを返す
+        best = self.ranking.get_best(self.participant_name)
+        return None if best is None else (best.path, best.result)
 
     def submissions_hash(self) -> int:
         return hash(tuple(self.get_submissions()))
 
 
 class SubmissionManager:
-    def __init__(self, submissions_dir: Path):
+    def __init__(self, submissions_dir: Path, results_index: Optional[ResultsIndex] = None):
         self.submissions_dir = submissions_dir
+        self.results_index = results_index
         self._create_submissions_dir()
+        self.store_version = StoreVersion(submissions_dir.joinpath(STORE_VERSION_FILENAME))
+        self._store_version = self.store_version.read()
+        self._watcher = None
+        if results_index is not None:
+            # インデックスはプロセスごとに持つため、起動時に提出ファイルから作り直す
+            results_index.rebuild(submissions_dir)
+            # アプリの外や他のインスタンスで追加・変更・削除された提出をインデックスに反映する
+            self._watcher = watch_submissions(submissions_dir, results_index)
+        self.ranking = Ranking()
+        self._results_version: Optional[int] = None
+        # 全セッションで共有されるため、参加者の辞書と結果の更新はこのロックの下で行う
+        self._lock = threading.RLock()
         self._participants = self.load_participant_name2obj()
 
     @property
     def participants(self) -> Dict[str, SingleParticipantSubmissions]:
-        self._update_participants()
-        return self._participants
+        with self._lock:
+            self._update_participants()
+            return dict(self._participants)
 
     def _create_submissions_dir(self):
         self.submissions_dir.mkdir(parents=True, exist_ok=True)
 
+    def update_results(self, evaluator: Evaluator):
+        """Updates every participant's results, unless the submissions have not changed since the last call."""
+        with self._lock:
+            version = self.get_version()
+            if version is not None and version == self._results_version:
+                return
+            for participant in self.participants.values():
+                participant.update_results(evaluator)
+            self._results_version = version
+
+    def get_rank(self, participant_name: str) -> Optional[int]:
+        return self.ranking.rank(participant_name)
+
+    def get_version(self) -> Optional[int]:
+        """Changes whenever a submission is added, changed or removed. None if the submissions are not indexed."""
+        if self.results_index is None:
+            return None
+        store_version = self.store_version.read()
+        if store_version != self._store_version:
+            # 他のインスタンスが提出を追加した。変更通知やポーリングを待たずにインデックスへ取り込む
+            self._store_version = store_version
+            self._watcher.poll()
+        return self.results_index.get_version()
+
     def participant_exists(self, participant_name: str) -> bool:
-        return participant_name in self._participants
+        with self._lock:
+            self._update_participants()
+            return participant_name in self._participants
 
     def get_participant(self, participant_name: str) -> SingleParticipantSubmissions:
-        return self._participants[participant_name]
+        with self._lock:
+            return self._participants[participant_name]
+
+    def _get_participant_names(self) -> List[str]:
+        if self.results_index is not None:
+            return self.results_index.get_participants()
+        return [x.parts[-1] for x in self.submissions_dir.iterdir() if x.is_dir()]
 
     def load_participant_name2obj(self) -> Dict[str, SingleParticipantSubmissions]:
-        return {x.parts[-1]: SingleParticipantSubmissions(x) for x in self.submissions_dir.iterdir() if x.is_dir()}
+        return {name: SingleParticipantSubmissions(self.submissions_dir.joinpath(name), self.results_index,
+                                                   self.ranking)
+                for name in self._get_participant_names()}
 
     def _update_participants(self):
-        existing_participants = {x.parts[-1] for x in self.submissions_dir.iterdir() if x.is_dir()}
-        for participant in self._participants:
+        existing_participants = set(self._get_participant_names())
+        if self.results_index is not None:
+            # 他のセッションで最初の提出をした参加者を追加し、提出がすべて削除された参加者を取り除く
+            for participant in existing_participants.difference(self._participants):
+                self._participants[participant] = SingleParticipantSubmissions(
+                    self.submissions_dir.joinpath(participant), self.results_index, self.ranking)
+            for participant in list(self._participants):
+                if participant not in existing_participants and self._participants[participant].records:
+                    del self._participants[participant]
+                    self.ranking.remove(participant)
+            return
+        for participant in list(self._participants):
             if participant not in existing_participants:
                 del self._participants[participant]
+                self.ranking.remove(participant)
 
     def add_participant(self, participant_name, exists_ok: bool = False):
         if not is_legal_filename(participant_name):
             raise ValueError('Illegal participant name. Must have only alphanumeric or ".-_ " characters, '
                              'without trailing or leading whitespaces.')
-        if participant_name in self._participants:
-            if not exists_ok:
-                raise ValueError(f"Participant {participant_name} already exists!")
-            return
-        self._participants[participant_name] = SingleParticipantSubmissions(
-            self.submissions_dir.joinpath(participant_name))
+        with self._lock:
+            if participant_name in self._participants:
+                if not exists_ok:
+                    raise ValueError(f"Participant {participant_name} already exists!")
+                return
+            self._participants[participant_name] = SingleParticipantSubmissions(
+                self.submissions_dir.joinpath(participant_name), self.results_index, self.ranking)